@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+import numpy as np
+from QualEvaluate import (DIFF_ENGINES, DIFF_DIST_REFERENCE, read_road_pred, read_road_true, best_match,
+                          build_match_index, release_match_index, diff_polygons, measure_diff, judge_points_count)
+
+
+def collect_pairs(shp_dir_pred, shp_dir_true, city, cache_dir=None):
+    """
+    定性評価で差分距離を算出する(予測ポリゴン, 最も重なっている正解ポリゴン)の組を集める
+    """
+    encoding = "utf-8" if city == "gifu" or city == "kaga" else "Shift-JIS"
+    data_true = {}
+    for file in os.listdir(shp_dir_true):
+        if file[-4:] == '.shp':
+            for data in read_road_true(os.path.join(shp_dir_true, file), city, encoding, cache_dir):
+                data_true.setdefault(data['id'], []).append(data)
+
+    data_pred = {}
+    for file in os.listdir(shp_dir_pred):
+        if file[-4:] == '.shp':
+            for pred in read_road_pred(os.path.join(shp_dir_pred, file)):
+                data_pred.setdefault(pred['id'], []).append(pred)
+
+    pairs = []
+    for road_id, check_pred in data_pred.items():
+        check_true = data_true.get(road_id)
+        if not check_true:
+            continue
+        index = build_match_index(check_true)
+        for pred in check_pred:
+            test = best_match(pred, check_true, index)
+            if test is not None:
+                pairs.append((pred['poly'], test['poly']))
+        release_match_index(index)
+    return pairs
+
+
+def judge_rank(diff, poly_pred):
+    """
+    差分距離によるポリゴンランク（judge_polygonと同じ基準）
+    """
+    if DIFF_DIST_REFERENCE < diff:
+        return judge_points_count(len(poly_pred.exterior.coords))
+    return 'A'
+
+
+def benchmark(pairs, engines, reference="skeleton"):
+    """
+    差分距離の算出方式毎の処理時間と、referenceとのランク不一致数を表示する
+    差分ポリゴンの作成は共通のため時間に含めない
+    定性評価と同じくmeasure_diffで算出し、skeletonが上限を超えて最大内接円で代用した数も表示する
+    """
+    polygons = [diff_polygons(poly_pred, poly_true) for poly_pred, poly_true in pairs]
+    print(f"差分ポリゴン数：{sum(p is not None for p in polygons)} / 判定ポリゴン数：{len(pairs)}")
+
+    results = {}
+    for engine in dict.fromkeys((reference,) + tuple(engines)):
+        start = time.perf_counter()
+        measured = [(0, False) if p is None else measure_diff(p[-1], engine) for p in polygons]
+        elapsed = time.perf_counter() - start
+        diffs = [diff for diff, _ in measured]
+        fallbacks = sum(fell_back for _, fell_back in measured)
+        ranks = [judge_rank(diff, poly_pred) for diff, (poly_pred, _) in zip(diffs, pairs)]
+        results[engine] = (elapsed, np.array(diffs, np.float64), ranks, fallbacks)
+
+    ref_elapsed, ref_diffs, ref_ranks, _ = results[reference]
+    print(f"{'engine':>10} {'時間(s)':>10} {'速度比':>8} {'ランク不一致':>12} {'不一致率':>8} {'差分距離の最大差(m)':>20} {'代用数':>8}")
+    for engine, (elapsed, diffs, ranks, fallbacks) in results.items():
+        mismatch = sum(rank != ref_rank for rank, ref_rank in zip(ranks, ref_ranks))
+        rate = mismatch / len(ranks) if ranks else 0
+        gap = np.abs(diffs - ref_diffs).max() if len(diffs) else 0
+        print(f"{engine:>10} {elapsed:>10.3f} {ref_elapsed / max(elapsed, 1e-9):>8.1f} {mismatch:>12} {rate:>8.2%} {gap:>20.3f} {fallbacks:>8}")
+    return results
+
+
+def main(shp_dir_pred, shp_dir_true, city, cache_dir=None, engines=tuple(DIFF_ENGINES)):
+    """
+    差分距離の算出方式の比較
+    Arguments:
+        shp_dir_pred: 予測結果shp格納フォルダ
+        shp_dir_true: 正解shp格納フォルダ
+        engines: 比較する算出方式（DIFF_ENGINESのキー）
+    """
+    pairs = collect_pairs(shp_dir_pred, shp_dir_true, city, cache_dir)
+    benchmark(pairs, engines)
+
+
+if __name__ == '__main__':
+
+    city = "sendai"
+    pred_name = "pred_5city"
+    true_name = "sendai_shp_lod2_add_id_intersection_6678"
+
+    data_path = os.path.join("data", city)
+    shp_dir_pred = os.path.join(data_path, pred_name)
+    shp_dir_true = os.path.join(data_path, true_name)
+    cache_dir = os.path.join("data", "true_cache") # 正解データの読み込み結果のキャッシュフォルダ（Noneの場合はキャッシュしない）
+    engines = ("skeleton", "mic", "raster") # 比較する差分距離の算出方式
+
+    main(shp_dir_pred, shp_dir_true, city, cache_dir, engines)
+    print("Done")
@@ -1,136 +1,165 @@
 # -*- coding: utf-8 -*-
 import sys
 import os
-from multiprocessing import Pool
+import math
+import time
+import hashlib
+import heapq
+import sqlite3
+from collections import Counter
+from contextlib import nullcontext
+from multiprocessing import Pool, resource_tracker
+from multiprocessing.shared_memory import SharedMemory
 import shutil
+import numpy as np
 import pandas as pd
-import shapefile
-from shapely.geometry import shape as Shape
-from shapely.geometry import Polygon, MultiPolygon, LineString
+import shapely
+from shapely.geometry import Polygon, MultiPolygon
 from shapely.geometry.collection import GeometryCollection
+from shapely.ops import polylabel
+from shapely.strtree import STRtree
 import polyskel
+from ResultWriter import ResultWriter
+from RoadLoader import (CLASSES, CLASS_INDEX, read_road_pred_columns, read_road_true_columns, columns_to_records,
+                        is_valid_columns, group_by_id, true_id_field, load_record_index, records_for_ids,
+                        read_road_true_records)
 from decimal import Decimal
 import decimal
-import gc
 import sys
 
+# ログ出力・デバッグ描画を行わない
+polyskel.set_production()
 
 DIFF_DIST_REFERENCE = 1.75
 EVALUATION_REFERENCE = 0.5
 # 許容する最小エッジ長
 TOLERANCE = 0.000000001
+# 最大内接円(mic)の許容誤差(m)
+MIC_TOLERANCE = 0.01
+# ラスタ(raster)のセルサイズ(m)と1辺の最大セル数
+RASTER_CELL_SIZE = 0.05
+RASTER_MAX_CELLS = 1024
+# skeleton計算1回あたりの上限（超えた場合は最大内接円の直径で代用する）
+SKELETON_MAX_EVENTS = 500000
+SKELETON_MAX_SECONDS = 30
+# 退化した差分ポリゴンでpolyskelが送出する例外（最大内接円の直径で代用する）
+SKELETON_FAILURES = (ValueError, IndexError, AttributeError, ZeroDivisionError, AssertionError)
+# 差分距離の保存形式・算出方法を変更した場合は上げる（保存済みの値を使わなくなる）
+DIFF_MEMO_VERSION = 1
+# 保存済みの差分距離の使用時刻を更新する間隔（秒）。これより新しい使用時刻は更新しない（件数削減の順序にはこの精度で十分）
+DIFF_MEMO_TOUCH_INTERVAL = 3600
 
 def read_road_pred(shp_path):
     """
     予測シェープファイル読み込み機能
     """
-    
-    def convert_class(set_class, set_intersec):
-        """
-        予測シェープファイルから正解シェープファイルのclass形式に変換
-        """
-        if set_class == 1:
-            if set_intersec == 1:
-                # 車道交差部
-                return 1020
-            else:
-                # 車道部
-                return 1000
-        elif set_class == 2:
-            # 歩道部
-            return 2000
-        elif set_class == 3:
-            # 島部
-            return 3000
-        else:
-            return set_class
-
-
-    shx_path = shp_path[:-4] + ".shx"
-    dbf_path = shp_path[:-4] + ".dbf"
-
-    shp_file = open(shp_path.encode("utf-8"), "rb")
-    shx_file = open(shx_path.encode("utf-8"), "rb")
-    dbf_file = open(dbf_path.encode("utf-8"), "rb")
-
-    data = []
-    with shapefile.Reader(shp=shp_file, shx=shx_file, dbf=dbf_file, encoding='Shift-JIS') as sf:
-        for sr in sf.iterShapeRecords(): 
-            id = sr.record["lod1_id"]
-            cls = sr.record["class"]
-            intersec = sr.record["is_in_inte"]
-
-            geom = Shape(sr.shape.__geo_interface__)
+    return columns_to_records(read_road_pred_columns(shp_path))
 
-            data.append({
-                "id" : id,
-                "class": str(convert_class(cls, intersec)),
-                "poly": geom
-                })
-
-    shp_file.close()
-    shx_file.close()
-    dbf_file.close()
-
-    return data
-
-def read_road_true(shp_path, encoding="Shift-JIS"):
+def read_road_true(shp_path, city, encoding="Shift-JIS", cache_dir=None):
     """
     正解シェープファイル読み込み機能
+    cache_dir: 読み込み結果のキャッシュフォルダ。Noneの場合はキャッシュしない
     """
-    shx_path = shp_path[:-4] + ".shx"
-    dbf_path = shp_path[:-4] + ".dbf"
-
-    shp_file = open(shp_path.encode("utf-8"), "rb")
-    shx_file = open(shx_path.encode("utf-8"), "rb")
-    dbf_file = open(dbf_path.encode("utf-8"), "rb")
-
-    data = []
-    with shapefile.Reader(shp=shp_file, shx=shx_file, dbf=dbf_file, encoding=encoding) as sf:
-        for sr in sf.iterShapeRecords(): 
-            if city == "sendai" or city == "mitaka":
-                id = sr.record["gml_id"]
-            else:
-                id = sr.record["id"]
-            cls = sr.record["class"]
-
-            if str(cls) not in ['1000', '1020', '2000', '3000']:
-                continue
+    columns = read_road_true_columns(shp_path, true_id_field(city), encoding=encoding, cache_dir=cache_dir)
+    return valid_records(columns)
 
-            if sr.shape.shapeType == 0:
-                continue  # NULL シェイプの場合は次のループへ
-            geom = Shape(sr.shape.__geo_interface__)
-            
-            if not geom.is_valid:
-                print("Geometry could not be fixed. Skipping.")
-                print(sr.record)
-                continue
+def true_files_by_id(shp_dir_true, shp_files_true, city, encoding):
+    """
+    道路ID→その道路IDのレコードを含む正解shpファイル名のリスト（shp_files_trueの順）
+    レコード索引（サイドカーファイル.ridx）は道路IDを取り出した後に解放する
+    """
+    files_by_id = {}
+    for file in shp_files_true:
+        index = load_record_index(os.path.join(shp_dir_true, file), true_id_field(city), encoding)
+        for check_id in index["id_records"]:
+            files_by_id.setdefault(check_id, []).append(file)
+    return files_by_id
 
-            data.append({
-                "id" : id,
-                "class": str(cls),
-                "poly": geom
-                })
+def read_road_true_paired(shp_dir_true, shp_files_true, file, files_by_id, ids, city, encoding, cache_dir=None):
+    """
+    予測shpと同名の正解shpを読み込み、他の正解shpにまたがる道路IDのレコードのみレコード索引を使って追加する
+    （ファイル・レコードの順はread_road_trueで全て読み込んだ場合と同じ）
+    Arguments:
+        file: 予測shpのファイル名
+        files_by_id: true_files_by_idの結果
+        ids: 対象道路ID
+    Returns:
+        dict: {id: [{"id":string, "class":string, "poly":polygon}]}
+    """
+    ids = set(ids)
+    needed = {true_file for check_id in ids for true_file in files_by_id.get(check_id, ())}
+    data_true = []
+    for true_file in shp_files_true:
+        if true_file not in needed:
+            continue
+        shp_path_true = os.path.join(shp_dir_true, true_file)
+        if true_file == file:
+            # 同名の正解shpは全て読み込み、対象道路IDのみ残す
+            data_true += [data for data in read_road_true(shp_path_true, city, encoding, cache_dir) if data['id'] in ids]
+        else:
+            # 道路IDがまたがる正解shpは対象道路IDのレコードのみ読み込む
+            index = load_record_index(shp_path_true, true_id_field(city), encoding)
+            data_true += valid_records(read_road_true_records(shp_path_true, records_for_ids(index, ids), index))
+    return group_by_id(data_true)
 
-    shp_file.close()
-    shx_file.close()
-    dbf_file.close()
+def valid_records(columns):
+    """
+    妥当なジオメトリのみ[{"id":string, "class":string, "poly":polygon}]形式に変換する
+    """
+    valid = is_valid_columns(columns)
+    for i in np.flatnonzero(~valid):
+        print("Geometry could not be fixed. Skipping.")
+        print(columns["id"][i], CLASSES[columns["class"][i]])
 
-    return data
+    return columns_to_records({key: value[valid] for key, value in columns.items()})
 
 def get_skeleton(poly):
-    skeleton = polyskel.skeletonize(poly, holes=[])
+    skeleton = polyskel.skeletonize(poly, holes=[], max_events=SKELETON_MAX_EVENTS, max_seconds=SKELETON_MAX_SECONDS)
     return skeleton
 
-def calc_diff(poly_pred, poly_true):
+def inscribed_heights(coords, sources, chunk_size=1 << 20):
     """
-    判定ポリゴン毎に差分ポリゴンを作成し、差分距離(m)を算出する
+    内接円毎の直径（中心点から各辺への高さx2のうち一番短いもの）をまとめて計算する
+    三角形の面積・辺の長さはshapely(GEOS)と同じ計算順序で求めるため、
+    Polygon・LineStringで計算した場合と同一の値になる
+    Arguments:
+        coords: 差分ポリゴンの外周座標のリスト
+        sources: ([n_arc, 2]) 内接円の中心座標
+    Returns:
+        ([n_arc]) 内接円毎の高さx2（有効な辺が無い場合は0）
+    """
+    pts = np.asarray(coords, np.float64)[:, :2]
+    x0, y0 = pts[:, 0], pts[:, 1]
+    x1, y1 = np.roll(x0, -1), np.roll(y0, -1)
+    # 辺の長さ
+    dx = x1 - x0
+    dy = y1 - y0
+    length = np.sqrt(dx * dx + dy * dy)
+
+    heights = np.empty(len(sources))
+    step = max(1, chunk_size // max(1, len(pts)))
+    for start in range(0, len(sources), step):
+        x2 = sources[start:start + step, 0:1]
+        y2 = sources[start:start + step, 1:2]
+        # 三角形(辺の両端, 中心点)の面積x2
+        area2 = np.abs(dx * (y0 - y2) + (x2 - x0) * dy)
+        valid = (area2 != 0) & (length != 0)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            height = np.where(valid, area2 / length * 2, np.inf)
+        height = height.min(axis=1)
+        height[np.isinf(height)] = 0
+        heights[start:start + step] = height
+    return heights
+
+def diff_polygons(poly_pred, poly_true):
+    """
+    判定ポリゴンの差分ポリゴンの外周座標のリストを作成する
+    差分が無い(完全一致)場合はNone
     """
     polygons = []
-    # Skeletonテスト
     poly_ = poly_pred.symmetric_difference(poly_true)
     if poly_.area < 0.001:
-        return 0
+        return None
     
     # MultiPolygon の場合は個別に simplify
     if isinstance(poly_, MultiPolygon):
@@ -153,47 +182,253 @@ def calc_diff(poly_pred, poly_true):
 
     if not polygons:
         # 差分なし(完全一致)
-        return 0
+        return None
 
     for poly in polygons:
         if len(poly) == 0:
             # 差分なし(完全一致)
-            return 0
-        
-        skeleton = get_skeleton(poly) #polyskel.skeletonize(poly, holes=[])
-        ls_height = []
-
-        #print("skeleton_count:", len(skeleton)) # 内接円の数
-        for arc in skeleton:
-            #print("source:", arc.source) # 内接円の中心ポイント
-            tmp_height = 0
-            # 内接円毎の処理
-            for i in range(len(poly)):
-                j = i+1
-                if i == len(poly)-1:
-                    j = 0
-                pt_i = poly[i]
-                pt_j = poly[j]
-
-                # 内接円の半径を計算(中心点と各辺から高さを計算)
-                tmp_poly = Polygon([pt_i, pt_j, (arc.source.x, arc.source.y)])
-                tmp_line = LineString([pt_i, pt_j])
-
-                if tmp_poly.area != 0 and tmp_line.length != 0:
-                    height = tmp_poly.area*2 / tmp_line.length
-                    if tmp_height != 0 and  tmp_height < height*2:
-                        continue
-                    # 高さ(円の半径)x2のうち、一番短いものを登録
-                    tmp_height =  height*2
-
-            ls_height.append(tmp_height)
-
-    del skeleton
-    gc.collect()
+            return None
+    return polygons
+
+def diff_dist_skeleton(poly):
+    """
+    差分距離：Skeletonの内接円の直径の最大値
+    """
+    skeleton = get_skeleton(poly) #polyskel.skeletonize(poly, holes=[])
+
+    #print("skeleton_count:", len(skeleton)) # 内接円の数
+    # 内接円の中心ポイント
+    sources = np.array([(arc.source.x, arc.source.y) for arc in skeleton], np.float64).reshape(-1, 2)
+    ls_height = list(inscribed_heights(poly, sources))
 
     # 各内接円から計算した距離のうち最大値を差分距離とする
     return max(ls_height)
 
+def diff_dist_mic(poly):
+    """
+    差分距離：最大内接円の直径（shapely 2.1未満はpolylabelで中心を求める）
+    """
+    polygon = Polygon(poly)
+    if hasattr(shapely, "maximum_inscribed_circle"):
+        # 中心から最も近い外周上の点への線分
+        return shapely.maximum_inscribed_circle(polygon, MIC_TOLERANCE).length * 2
+    center = polylabel(polygon, MIC_TOLERANCE)
+    return center.distance(polygon.exterior) * 2
+
+def rasterize_ring(coords, x_origin, y_origin, cell, nx, ny):
+    """
+    外周座標の内側にセル中心があるセルを走査線（偶奇規則）で求める
+    Arguments:
+        x_origin, y_origin: 左下のセル中心の座標
+    Returns:
+        ([ny, nx]) 内側ならTrue
+    """
+    pts = np.asarray(coords, np.float64)[:, :2]
+    x0, y0 = pts[:, 0], pts[:, 1]
+    x1, y1 = np.roll(x0, -1), np.roll(y0, -1)
+    ys = y_origin + np.arange(ny)[:, np.newaxis] * cell
+    # 各行のセル中心の高さを跨ぐ辺との交点（下端を含み上端を含まない）
+    crosses = (np.minimum(y0, y1) <= ys) & (ys < np.maximum(y0, y1))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        xs = np.where(crosses, x0 + (ys - y0) * (x1 - x0) / (y1 - y0), np.nan)
+    xs.sort(axis=1)
+    # 交点を2つずつ組にした区間の内側のセル
+    starts = np.ceil((xs[:, 0::2] - x_origin) / cell)
+    ends = np.ceil((xs[:, 1::2] - x_origin) / cell)
+    rows, spans = np.nonzero(~np.isnan(starts[:, :ends.shape[1]]))
+    counts = np.zeros((ny, nx + 1), np.int32)
+    np.add.at(counts, (rows, np.clip(starts[rows, spans], 0, nx).astype(np.intp)), 1)
+    np.add.at(counts, (rows, np.clip(ends[rows, spans], 0, nx).astype(np.intp)), -1)
+    return counts.cumsum(axis=1)[:, :nx] > 0
+
+def diff_dist_raster(poly):
+    """
+    差分距離：ラスタ化した差分ポリゴンの距離変換の最大値x2
+    セル中心の内外判定で求めるため、誤差はセルサイズ程度
+    """
+    from scipy import ndimage  # ラスタエンジン使用時のみ必要
+
+    pts = np.asarray(poly, np.float64)[:, :2]
+    minx, miny = pts.min(axis=0)
+    maxx, maxy = pts.max(axis=0)
+    cell = max(RASTER_CELL_SIZE, max(maxx - minx, maxy - miny) / RASTER_MAX_CELLS)
+    # 外周に1セルずつ余白を取る
+    nx = int(np.ceil((maxx - minx) / cell)) + 2
+    ny = int(np.ceil((maxy - miny) / cell)) + 2
+    inside = rasterize_ring(pts, minx - 0.5 * cell, miny - 0.5 * cell, cell, nx, ny)
+    if not inside.any():
+        return 0
+    # 内側のセル中心から最も近い外側のセル中心までの距離（外周までは約半セル短い）
+    dist = ndimage.distance_transform_edt(inside)
+    return max(dist.max() - 0.5, 0) * cell * 2
+
+# 差分距離の算出方式
+DIFF_ENGINES = {
+    "skeleton": diff_dist_skeleton,
+    "mic": diff_dist_mic,
+    "raster": diff_dist_raster,
+}
+
+# プロセス毎の差分距離の保存先への接続
+_diff_memos = {}
+
+def open_diff_memo(memo_path):
+    """
+    差分距離の保存先(sqlite)への接続（プロセス毎に1つ）
+    """
+    key = (os.path.abspath(memo_path), os.getpid())
+    if key not in _diff_memos:
+        os.makedirs(os.path.dirname(key[0]), exist_ok=True)
+        memo = sqlite3.connect(memo_path, timeout=60, isolation_level=None)
+        memo.execute("PRAGMA journal_mode=WAL")
+        memo.execute("PRAGMA synchronous=NORMAL")
+        memo.execute("CREATE TABLE IF NOT EXISTS diff_memo (key BLOB PRIMARY KEY, value REAL NOT NULL, used REAL NOT NULL) WITHOUT ROWID")
+        memo.execute("CREATE INDEX IF NOT EXISTS diff_memo_used ON diff_memo (used)")
+        _diff_memos[key] = memo
+    return _diff_memos[key]
+
+def diff_memo_key(poly_pred, poly_true, engine):
+    """
+    予測・正解ポリゴンのWKBと差分距離の算出設定のハッシュ値
+    """
+    h = hashlib.blake2b(digest_size=16)
+    h.update(repr((DIFF_MEMO_VERSION, engine, TOLERANCE, MIC_TOLERANCE, RASTER_CELL_SIZE, RASTER_MAX_CELLS)).encode("utf-8"))
+    h.update(shapely.to_wkb(poly_pred))
+    h.update(b"|")
+    h.update(shapely.to_wkb(poly_true))
+    return h.digest()
+
+def diff_memo_get(memo, key):
+    """
+    保存済みの差分距離（無い場合はNone）。使用時刻がDIFF_MEMO_TOUCH_INTERVAL以上古い場合のみ更新する
+    """
+    row = memo.execute("SELECT value, used FROM diff_memo WHERE key = ?", (key,)).fetchone()
+    if row is None:
+        return None
+    now = time.time()
+    if row[1] < now - DIFF_MEMO_TOUCH_INTERVAL:
+        memo.execute("UPDATE diff_memo SET used = ? WHERE key = ?", (now, key))
+    return row[0]
+
+def diff_memo_put(memo, key, value):
+    memo.execute("INSERT OR REPLACE INTO diff_memo (key, value, used) VALUES (?, ?, ?)", (key, float(value), time.time()))
+
+def trim_diff_memo(memo, max_entries):
+    """
+    保存件数がmax_entriesを超えた分を使用時刻の古い順に削除する
+    """
+    count = memo.execute("SELECT COUNT(*) FROM diff_memo").fetchone()[0]
+    if count > max_entries:
+        memo.execute("DELETE FROM diff_memo WHERE key IN (SELECT key FROM diff_memo ORDER BY used LIMIT ?)", (count - max_entries,))
+        print(f"差分距離の保存件数：{count} -> {max_entries}")
+
+def measure_diff(poly, engine="skeleton"):
+    """
+    差分ポリゴンの差分距離
+    skeletonが上限(SKELETON_MAX_EVENTS・SKELETON_MAX_SECONDS)を超えた場合や、
+    退化したポリゴンで算出できない場合(SKELETON_FAILURES)は最大内接円の直径で代用する
+    Returns:
+        (差分距離, 代用したか)
+    """
+    if engine != "skeleton":
+        return DIFF_ENGINES[engine](poly), False
+    try:
+        return diff_dist_skeleton(poly), False
+    except polyskel.SkeletonBudgetExceeded as e:
+        print("skeletonの計算を打ち切り、最大内接円で代用:", e)
+    except SKELETON_FAILURES as e:
+        print("skeletonを算出できず、最大内接円で代用:", repr(e))
+    return diff_dist_mic(poly), True
+
+def calc_diff(poly_pred, poly_true, engine="skeleton", memo=None):
+    """
+    判定ポリゴン毎に差分ポリゴンを作成し、差分距離(m)を算出する
+    engine: 差分距離の算出方式（DIFF_ENGINESのキー）
+    memo: 差分距離の保存先（open_diff_memo、Noneの場合は保存しない）
+    """
+    if memo is not None:
+        key = diff_memo_key(poly_pred, poly_true, engine)
+        diff = diff_memo_get(memo, key)
+        if diff is None:
+            polygons = diff_polygons(poly_pred, poly_true)
+            if polygons is None:
+                diff, fallback = 0, False
+            else:
+                diff, fallback = measure_diff(polygons[-1], engine)
+            # 代用値は保存しない
+            if not fallback:
+                diff_memo_put(memo, key, diff)
+        return diff
+
+    polygons = diff_polygons(poly_pred, poly_true)
+    if polygons is None:
+        return 0
+
+    # 従来通り最後の差分ポリゴンの値を差分距離とする
+    return measure_diff(polygons[-1], engine)[0]
+
+# 差分距離の判定を決めた段階
+DIFF_STAGES = {
+    "equal": "形状が一致",
+    "memo": "保存済みの差分距離を使用",
+    "empty": "差分なし",
+    "area": "面積による上限が基準値以下",
+    "width": "最小外接矩形の幅が基準値以下",
+    "engine": "差分距離を算出",
+    "fallback": "skeletonを打ち切り・算出できず最大内接円で代用",
+}
+
+def rectangle_width(polygon):
+    """
+    ポリゴンの最小外接矩形（向き任意）の短辺の長さ
+    """
+    rect = shapely.oriented_envelope(polygon)
+    if not isinstance(rect, Polygon):
+        # 線・点に退化
+        return 0
+    coords = np.asarray(rect.exterior.coords)
+    return np.hypot(*(coords[1:3] - coords[0:2]).T).min()
+
+def judge_diff(poly_pred, poly_true, engine="skeleton", memo=None):
+    """
+    差分距離がDIFF_DIST_REFERENCEを超えるかを判定する
+    skeletonの場合、差分距離（内接円の中心から各辺の直線までの距離x2）は差分ポリゴンの
+    最大内接円の直径以下のため、面積・幅による上限が基準値以下なら算出を省略する
+    memo: 差分距離の保存先（open_diff_memo、Noneの場合は保存しない）
+    Returns:
+        (判定を決めた段階(DIFF_STAGESのキー), 基準値を超えるか)
+    """
+    if poly_pred.equals_exact(poly_true, 0):
+        return "equal", False
+
+    if memo is not None:
+        key = diff_memo_key(poly_pred, poly_true, engine)
+        diff = diff_memo_get(memo, key)
+        if diff is not None:
+            return "memo", DIFF_DIST_REFERENCE < diff
+
+    polygons = diff_polygons(poly_pred, poly_true)
+    if polygons is None:
+        return "empty", False
+
+    # 従来通り最後の差分ポリゴンで判定する
+    poly = polygons[-1]
+    if engine == "skeleton":
+        polygon = Polygon(poly)
+        # 内接円の面積は差分ポリゴンの面積以下
+        if 2 * math.sqrt(polygon.area / math.pi) <= DIFF_DIST_REFERENCE:
+            return "area", False
+        # 内接円は最小外接矩形に収まる
+        if rectangle_width(polygon) <= DIFF_DIST_REFERENCE:
+            return "width", False
+
+    diff, fallback = measure_diff(poly, engine)
+    if fallback:
+        return "fallback", DIFF_DIST_REFERENCE < diff
+    if memo is not None:
+        diff_memo_put(memo, key, diff)
+    return "engine", DIFF_DIST_REFERENCE < diff
+
 def judge_points_count(points_count):
     """
     ポリコン単位で工数削減率区分を判定
@@ -205,9 +440,66 @@ def judge_points_count(points_count):
     else:
         return('D')
 
-def judge_polygon(check_pred, check_true, cheak_id):
+def build_match_index(check_true):
+    """
+    道路IDの正解ポリゴンのクラス毎の空間インデックス（STRtree）
+    正解ポリゴンはprepareするため、使用後はrelease_match_indexで解放する
+    Returns:
+        {クラス: (STRtree, 正解ポリゴンの配列, check_trueでの位置の配列)}
+    """
+    positions = {}
+    for i, test in enumerate(check_true):
+        positions.setdefault(test.get('class'), []).append(i)
+
+    index = {}
+    for cls, idx in positions.items():
+        polys = np.array([check_true[i].get('poly') for i in idx], dtype=object)
+        shapely.prepare(polys)
+        index[cls] = (STRtree(polys), polys, np.array(idx, np.intp))
+    return index
+
+def release_match_index(index):
+    for _, polys, _ in index.values():
+        shapely.destroy_prepared(polys)
+
+def best_match(pred, check_true, index=None):
+    """
+    予測ポリゴンと同じクラスで最も重なっている正解ポリゴン（重なりが無い場合はNone）
+    重なり面積が同じ場合はcheck_trueで先の正解ポリゴンを選ぶ
+    index: build_match_indexの結果（Noneの場合はその場で作成する）
+    """
+    if index is None:
+        index = build_match_index(check_true)
+        try:
+            return best_match(pred, check_true, index)
+        finally:
+            release_match_index(index)
+
+    entry = index.get(pred.get('class'))
+    if entry is None:
+        return None
+    tree, polys, positions = entry
+    poly_pred = pred.get('poly')
+
+    # bboxが重なる同じクラスの正解ポリゴンのみ、check_trueの並び順で重なり面積を計算
+    best, best_area = None, 0
+    for i in np.sort(tree.query(poly_pred)):
+        if not polys[i].intersects(poly_pred):
+            continue
+        area = poly_pred.intersection(polys[i]).area
+        if best_area < area:
+            best, best_area = positions[i], area
+
+    if best is None:
+        return None
+    return check_true[best]
+
+def judge_polygon(check_pred, check_true, cheak_id, engine="skeleton", counts=None, memo=None):
     """
     道路ID単位のポリゴン判定
+    engine: 差分距離の算出方式（DIFF_ENGINESのキー）
+    counts: 差分距離の判定を決めた段階毎のポリゴン数を加算するdict（Noneの場合は数えない）
+    memo: 差分距離の保存先（open_diff_memo、Noneの場合は保存しない）
     """
 
     #print("予測ポリゴン数：{} 正解ポリゴン数：{} id:{}:".format(len(check_pred), len(check_true), cheak_id))
@@ -223,33 +515,29 @@ def judge_polygon(check_pred, check_true, cheak_id):
 
     error_count = 0  # 誤りポリゴン数
     polys_rank = []
+    index = build_match_index(check_true)
     for pred in check_pred:
         # 予測ポリゴン毎に処理
-        set_area = []
-        for test in check_true:
-            # 予測と正解ポリゴンの建物IDが一致している場合の重なり面積を計算
-            if pred.get('class') == test.get('class'):
-                set_area.append(pred.get('poly').intersection(test.get('poly')).area)
-            else:
-                set_area.append(0)
-
-        if max(set_area) == 0:
+        test = best_match(pred, check_true, index)
+        if test is None:
             # 重なり面積が0の場合は誤りポリゴンとする
             error_count += 1
             #polys_rank.append(judge_points_count(len(pred.get('poly').exterior.coords)))
             polys_rank.append("E")
             continue
 
-        # 最も重なっているポリゴン同士の差分距離を計算
-        diff = calc_diff(pred.get('poly'), check_true[set_area.index(max(set_area))].get('poly'))
-        #print("skeleton_diff:", diff)
+        # 最も重なっているポリゴン同士の差分距離を判定
+        stage, exceeds = judge_diff(pred.get('poly'), test.get('poly'), engine, memo)
+        if counts is not None:
+            counts[stage] = counts.get(stage, 0) + 1
 
-        if DIFF_DIST_REFERENCE < diff:
+        if exceeds:
             # 予測と正解のポリゴンが基準値以上離れている場合を誤りとする
             error_count += 1
             polys_rank.append(judge_points_count(len(pred.get('poly').exterior.coords)))
         else:
             polys_rank.append('A')
+    release_match_index(index)
 
     # 評価値　＝　誤りポリゴン数 / 道路IDの全ポリゴン数
     if error_count:
@@ -265,44 +553,215 @@ def judge_polygon(check_pred, check_true, cheak_id):
 
     return road_rank, polys_rank
 
-def write_file(shp_path, poly_judge_results):
-
-    shx_path = shp_path[:-4] + ".shx"
-    dbf_path = shp_path[:-4] + ".dbf"
-
-    shp_file = open(shp_path.encode("utf-8"), "wb")
-    shx_file = open(shx_path.encode("utf-8"), "wb")
-    dbf_file = open(dbf_path.encode("utf-8"), "wb")
-
-    with shapefile.Writer(
-        shp=shp_file, shx=shx_file, dbf=dbf_file,
-        encoding='Shift-JIS', shapeType=shapefile.POLYGON) as file:
-
-        # 属性情報の設定
-        file.field(name='road_id', fieldType='C')    # テキスト型のroad_id属性
-        file.field(name='road_rank', fieldType='C')  # テキスト型のroad_rank属性
-        file.field(name='poly_id', fieldType='C')    # テキスト型のpoly_id属性
-        file.field(name='poly_rank', fieldType='C')  # テキスト型のpoly_rank属性
-
-        # レコードとポリゴン情報の追加
-        for i, poly in enumerate(poly_judge_results['poly']):
-            file.record(poly_judge_results['road_id'][i], poly_judge_results['road_rank'][i],
-                       poly_judge_results['poly_id'][i], poly_judge_results['poly_rank'][i])
-            points = list(poly.exterior.coords)
-            file.poly([points])
+def judge_polygon_report(check_pred, check_true, cheak_id, engine="skeleton", skeleton_stats=False, memo_path=None):
+    """
+    道路ID単位のポリゴン判定（集計情報付き）
+    memo_path: 差分距離の保存先（Noneの場合は保存しない）
+    戻り値: (judge_polygonの結果, 差分距離の判定段階毎のポリゴン数, polyskel.Stats（skeleton_statsがFalseの場合はNone）)
+    """
+    counts = {}
+    memo = open_diff_memo(memo_path) if memo_path is not None else None
+    if not skeleton_stats:
+        return judge_polygon(check_pred, check_true, cheak_id, engine, counts, memo), counts, None
+
+    stats = polyskel.Stats()
+    polyskel.set_stats(stats)
+    try:
+        return judge_polygon(check_pred, check_true, cheak_id, engine, counts, memo), counts, stats
+    finally:
+        polyskel.set_stats(None)
+
+def share_records(records):
+    """
+    レコードのポリゴン（座標・リング/ポリゴンのオフセット）とクラスコードを共有メモリに書き込む
+    戻り値: (SharedMemory, ワーカーに渡す配置情報)
+    """
+    polys = np.array([record['poly'] for record in records], dtype=object)
+    # Polygon・MultiPolygonが混在する場合はMultiPolygonとして書き込み、単一かどうかを別に持つ
+    geom_type, coords, offsets = shapely.to_ragged_array(polys)
+    single = shapely.get_type_id(polys) == shapely.GeometryType.POLYGON
+    codes = np.array([CLASS_INDEX[record['class']] if record['class'] is not None else -1 for record in records], np.int8)
+
+    arrays = [np.ascontiguousarray(array) for array in (coords, *offsets, single, codes)]
+    layout = []
+    size = 0
+    for array in arrays:
+        layout.append((array.dtype.str, array.shape, size))
+        size += -(-array.nbytes // 8) * 8
+    shm = SharedMemory(create=True, size=max(size, 1))
+    for (dtype, shape, offset), array in zip(layout, arrays):
+        np.ndarray(shape, dtype, shm.buf, offset)[...] = array
+    return shm, (shm.name, int(geom_type), len(offsets), layout)
+
+# ワーカー毎の共有メモリへの接続 {名前: (SharedMemory, 配列)}
+_shared_blocks = {}
+
+def _attach_records(block):
+    name, _, _, layout = block
+    if name not in _shared_blocks:
+        # 前のファイルの共有メモリを閉じる
+        for old in list(_shared_blocks):
+            _shared_blocks.pop(old)[0].close()
+        # 共有メモリの削除は作成したプロセスが行う（ワーカー終了時に削除・警告されないようにする）
+        try:
+            shm = SharedMemory(name=name, track=False)  # Python 3.13以降
+        except TypeError:
+            shm = SharedMemory(name=name)
+            if os.name == "posix":
+                resource_tracker.unregister(shm._name, "shared_memory")
+        _shared_blocks[name] = (shm, [np.ndarray(shape, dtype, shm.buf, offset) for dtype, shape, offset in layout])
+    return _shared_blocks[name][1]
+
+def shared_records(block, start, stop, check_id):
+    """
+    共有メモリのレコード[start, stop)を[{"id":string, "class":string, "poly":polygon}]形式に戻す
+    """
+    if start == stop:
+        return []
+    _, geom_type, n_offsets, _ = block
+    arrays = _attach_records(block)
+    coords, offsets, single, codes = arrays[0], arrays[1:1 + n_offsets], arrays[-2], arrays[-1]
+
+    # 外側のオフセットから順に範囲を絞る（座標はコピーせずに参照する）
+    sliced = []
+    lo, hi = start, stop
+    for offset in reversed(offsets):
+        sliced.append(offset[lo:hi + 1] - offset[lo])
+        lo, hi = offset[lo], offset[hi]
+    polys = shapely.from_ragged_array(shapely.GeometryType(geom_type), coords[lo:hi], tuple(reversed(sliced)))
+    if geom_type == shapely.GeometryType.MULTIPOLYGON:
+        parts = single[start:stop]
+        polys[parts] = shapely.get_geometry(polys[parts], 0)
+
+    return [
+        {"id": check_id, "class": CLASSES[code] if code >= 0 else None, "poly": poly}
+        for code, poly in zip(codes[start:stop].tolist(), polys.tolist())
+    ]
+
+def _judge_road_chunk(tasks):
+    results = []
+    for index, block, pred_range, true_range, check_id, args in tasks:
+        start = time.perf_counter()
+        check_pred = shared_records(block, *pred_range, check_id)
+        check_true = shared_records(block, *true_range, check_id)
+        result = judge_polygon_report(check_pred, check_true, check_id, *args)
+        results.append((index, result, time.perf_counter() - start))
+    return results
+
+def estimate_road_cost(check_pred, check_true):
+    """
+    道路IDの処理コストの見積もり（安価な特徴量のみ使用）
+    重なり面積を計算するポリゴンの組数と、正解と同一形状でない予測ポリゴン（差分距離の算出対象）の頂点数の和
+    """
+    if not check_pred or not check_true:
+        return 0
+    polys_pred = [data['poly'] for data in check_pred]
+    same = set(shapely.to_wkb([data['poly'] for data in check_true]).tolist())
+    changed = np.array([wkb not in same for wkb in shapely.to_wkb(polys_pred).tolist()])
+    return int(shapely.get_num_coordinates(polys_pred)[changed].sum()) + len(check_pred) * len(check_true)
 
-    shp_file.close()
-    shx_file.close()
-    dbf_file.close()
+def cost_chunks(costs, count):
+    """
+    タスクを見積もりコストの高い順に並べ、コストの合計が全体のおよそ1/count、
+    またはタスク数が全体の1/countになるまでまとめる（重いタスクは単独で先に渡す）
+    戻り値: タスク番号のリストのリスト
+    """
+    # コストが全て0の場合（正解ポリゴンの無い道路IDのみ等）はタスク数のみでまとめる
+    target = sum(costs) / count or math.inf
+    max_size = max(1, len(costs) // count)
+    chunks = []
+    chunk = []
+    total = 0
+    for index in sorted(range(len(costs)), key=lambda i: costs[i], reverse=True):
+        chunk.append(index)
+        total += costs[index]
+        if total >= target or len(chunk) >= max_size:
+            chunks.append(chunk)
+            chunk = []
+            total = 0
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+def simulate_idle(durations, chunks, workers):
+    """
+    chunksの順に空いたプロセスへ渡した場合の、全プロセスが終わるまでの待ち時間の合計(秒)
+    durations: タスク毎の処理時間(秒)
+    """
+    free = [0.0] * workers
+    for chunk in chunks:
+        heapq.heappush(free, heapq.heappop(free) + sum(durations[index] for index in chunk))
+    return workers * max(free) - sum(durations)
 
-def main(shp_dir_pred, shp_dir_true, result_dir, city):
+def judge_roads(tasks, pool=None, workers=1, idle=None):
+    """
+    道路ID毎のjudge_polygon_reportの実行（poolがNoneの場合は逐次処理）
+    並列処理ではポリゴンを共有メモリに一度だけ書き込み、各プロセスにはレコードの範囲のみ渡す
+    見積もりコストの高い道路IDから処理する
+    tasks: judge_polygon_reportの引数のリスト
+    idle: 並列処理の待ち時間のシミュレーション結果(秒)を加算するdict（"fifo": 道路ID順、"cost": コスト順）
+    戻り値: tasksと同じ順の結果のリスト
+    """
+    if pool is None:
+        return [judge_polygon_report(*args) for args in tasks]
+    if not tasks:
+        return []
+
+    records = []
+    ranges = []
+    for check_pred, check_true, _, *_ in tasks:
+        pred_range = (len(records), len(records) + len(check_pred))
+        records.extend(check_pred)
+        true_range = (len(records), len(records) + len(check_true))
+        records.extend(check_true)
+        ranges.append((pred_range, true_range))
+
+    # プロセス間通信の回数を減らすため、軽い道路IDはまとめて渡す
+    chunks = cost_chunks([estimate_road_cost(task[0], task[1]) for task in tasks], workers * 4)
+    shm, block = share_records(records)
+    try:
+        shared_chunks = (
+            [(index, block, *ranges[index], tasks[index][2], tasks[index][3:]) for index in chunk]
+            for chunk in chunks
+        )
+        results = [None] * len(tasks)
+        durations = [0.0] * len(tasks)
+        for part in pool.imap_unordered(_judge_road_chunk, shared_chunks):
+            for index, result, seconds in part:
+                results[index] = result
+                durations[index] = seconds
+    finally:
+        shm.close()
+        shm.unlink()
+
+    if idle is not None:
+        # 同じ処理時間で、道路ID順に同数ずつまとめて渡した場合と比較する
+        chunksize = max(1, len(tasks) // (workers * 4))
+        fifo = [list(range(start, min(start + chunksize, len(tasks)))) for start in range(0, len(tasks), chunksize)]
+        idle["fifo"] = idle.get("fifo", 0) + simulate_idle(durations, fifo, workers)
+        idle["cost"] = idle.get("cost", 0) + simulate_idle(durations, chunks, workers)
+    return results
+
+def main(shp_dir_pred, shp_dir_true, result_dir, city, cache_dir=None, skeleton_stats=False, diff_engine="skeleton",
+         memo_path=None, memo_max_entries=1000000, workers=None, streaming=False,
+         output_format="shp"):
     """
     定性評価＆経済効果算出為のポリコン評価
     Arguments:
         shp_dir_pred: 予測結果shp格納フォルダ
         shp_dir_true: 正解shp格納フォルダ ★shpファイル名前は予測結果と同じことを前提
         result_dir: 評価結果フォルダ
+        cache_dir: 正解データの読み込み結果のキャッシュフォルダ（Noneの場合はキャッシュしない）
+        skeleton_stats: Trueの場合、スケルトン計算のイベント数・処理時間を集計して表示する
+        diff_engine: 差分距離の算出方式（"skeleton" / "mic" / "raster"）
+        memo_path: 差分距離の保存先(sqlite)。前回と同じ予測・正解ポリゴンの組は保存済みの値を使う（Noneの場合は保存しない）
+        memo_max_entries: 差分距離の最大保存件数（超えた分は使用時刻の古い順に削除）
+        workers: 並列プロセス数（Noneの場合はCPU数、1の場合は逐次処理）
+        streaming: Trueの場合、正解は予測shp毎に同名の正解shpと、道路IDがまたがる他の正解shpのレコードのみ読み込み、処理後に解放する
+        output_format: 予測shp毎の結果の出力形式（"shp" / "gpkg" / "parquet"、RESULT_FORMATS参照）
     """
+    if workers is None:
+        workers = os.cpu_count()
     pred_poly_count = 0
     true_poly_count = 0
 
@@ -310,149 +769,86 @@ def main(shp_dir_pred, shp_dir_true, result_dir, city):
         shutil.rmtree(result_dir)
     os.makedirs(result_dir)
     
-    all_road_judge_results = { 'file':[], 'road_id':[], 'road_rank':[] }
-    all_poly_judge_results = { 'file':[], 'road_id':[], 'road_rank':[], 'poly_id':[], 'poly_rank':[], 'poly_area': [] }
+    stage_counts = Counter()
+    skeleton_total = polyskel.Stats()
+    idle = {}
 
     shp_files_pred = [file for file in os.listdir(shp_dir_pred) if file[-4:]=='.shp']
     shp_files_true = [file for file in os.listdir(shp_dir_true) if file[-4:]=='.shp']
     
-    #trueのポリゴン全て取り出しておく
-    data_true = []
-    for file in shp_files_true:
-        shp_path_true = os.path.join(shp_dir_true, file)
-        encoding = "Shift-JIS"
-        if city=="gifu" or city=="kaga":
-            encoding = "utf-8"
-        data_true.extend(read_road_true(shp_path_true, encoding))
-
+    encoding = "Shift-JIS"
+    if city=="gifu" or city=="kaga":
+        encoding = "utf-8"
 
-    for file in shp_files_pred:
-        shp_path_pred = os.path.join(shp_dir_pred, file)
+    if streaming:
+        # 道路ID→正解shpファイル名（レコード索引から作成）
+        files_by_id = true_files_by_id(shp_dir_true, shp_files_true, city, encoding)
+    else:
+        #trueのポリゴン全て取り出し、道路ID毎に振り分けておく
+        data_true = []
+        for file in shp_files_true:
+            shp_path_true = os.path.join(shp_dir_true, file)
+            data_true.extend(read_road_true(shp_path_true, city, encoding, cache_dir))
+        groups_true = group_by_id(data_true)
+        del data_true
+
+
+    # 全ファイル共通のプロセスプール（workersが1の場合は逐次処理）
+    with Pool(workers) if workers > 1 else nullcontext() as pool, ResultWriter(result_dir, output_format, shp_dir_pred) as writer:
+        for file in shp_files_pred:
+            shp_path_pred = os.path.join(shp_dir_pred, file)
         
-        # 予測データ：[{"id":string, "class":string, "poly":polygon}]
-        data_pred = read_road_pred(shp_path_pred)   
+            # 予測データ：[{"id":string, "class":string, "poly":polygon}]
+            data_pred = read_road_pred(shp_path_pred)   
         
-        # 判定対象道路ID一覧
-        ids = set([d['id'] for d in data_pred])
-
-        # 道路ID単位で誤りポリコン数による道路ランク判定
-        # 点数によるポリコンランク判定
-        road_judge_results = { 'road_id':[], 'road_rank':[], 'polys_rank':[], 'polys':[] }
-        if True:
-            nr_processors = 8
-            with Pool(nr_processors) as pool:
-                results = []
-                for check_id in ids:        
-                    #if check_id != "tran_dda42548-18e6-4a39-b64c-e5e54d81bf09":
-                    #    continue
-
-                    #print("道路ID単位の処理:", check_id)
-                    check_pred = [] # 予測ポリゴン：[{"id":string, "class":string, "poly":polygon}]
-                    for data in data_pred:
-                        if data.get('id') == check_id:
-                            check_pred.append(data)
-                            pred_poly_count += 1
-
-                    check_true = [] # 正解ポリゴン：[{"id":string, "class":string, "poly":polygon}]
-                    for data in data_true:
-                        if data.get('id') == check_id:
-                            check_true.append(data)
-                            true_poly_count += 1
-
-                    result = pool.apply_async(judge_polygon, args=(check_pred, check_true, check_id,))
-                    results.append(result)
-
-                    road_judge_results['road_id'].append(check_id)
-                    road_judge_results['polys'].append([data['poly'] for data in check_pred])
-
-                for result in results:
-                    road_rank, polys_rank = result.get()
-                    road_judge_results['road_rank'].append(road_rank)
-                    road_judge_results['polys_rank'].append(polys_rank)
-        else:
-            results = []
-            for check_id in ids:        
-                #if check_id != "tran_4f29901e-588c-43ce-9fdd-e7f111d4f414":
-                #    continue
-
-                print("道路ID単位の処理:", check_id)
-
-                check_pred = [] # 予測ポリゴン：[{"id":string, "class":string, "poly":polygon}]
-                for data in data_pred:
-                    if data.get('id') == check_id:
-                        check_pred.append(data)
-
-                check_true = [] # 正解ポリゴン：[{"id":string, "class":string, "poly":polygon}]
-                for data in data_true:
-                    if data.get('id') == check_id:
-                        check_true.append(data)
-
-                result = judge_polygon(check_pred, check_true, check_id)
-                results.append(result)
+            # 判定対象道路ID毎の予測ポリゴン
+            groups_pred = group_by_id(data_pred)
+            if streaming:
+                # 同名の正解shpと、道路IDがまたがる他の正解shpから対象道路IDのレコードのみ読み込む
+                groups_true = read_road_true_paired(shp_dir_true, shp_files_true, file, files_by_id, groups_pred,
+                                                    city, encoding, cache_dir)
+
+            # 道路ID単位で誤りポリコン数による道路ランク判定
+            # 点数によるポリコンランク判定
+            road_judge_results = { 'road_id':[], 'road_rank':[], 'polys_rank':[], 'polys':[] }
+            tasks = []
+            for check_id, check_pred in groups_pred.items():
+                # 予測・正解ポリゴン：[{"id":string, "class":string, "poly":polygon}]
+                check_true = groups_true.get(check_id, [])
+                pred_poly_count += len(check_pred)
+                true_poly_count += len(check_true)
+
+                tasks.append((check_pred, check_true, check_id, diff_engine, skeleton_stats, memo_path))
 
                 road_judge_results['road_id'].append(check_id)
                 road_judge_results['polys'].append([data['poly'] for data in check_pred])
 
-            for result in results:
-                road_rank, polys_rank = result
+            for (road_rank, polys_rank), counts, stats in judge_roads(tasks, pool, workers, idle):
+                stage_counts.update(counts)
+                if stats is not None:
+                    skeleton_total.merge(stats)
                 road_judge_results['road_rank'].append(road_rank)
                 road_judge_results['polys_rank'].append(polys_rank)
 
-        for i, road_id in enumerate(road_judge_results['road_id']):
-            all_road_judge_results['file'].append(file)
-            all_road_judge_results['road_id'].append(road_id)
-            all_road_judge_results['road_rank'].append(road_judge_results['road_rank'][i])
+            # ポリコンランク判定結果
+            poly_judge_results = { 'road_id':[], 'road_rank':[], 'poly_id':[], 'poly_rank':[], 'poly':[] }
+            for i, road_id in enumerate(road_judge_results['road_id']):
+                road_rank = road_judge_results['road_rank'][i]
+                for j, poly in enumerate(road_judge_results['polys'][i]):
+                    poly_rank = road_judge_results['polys_rank'][i][j]
 
-        # 道路ランク判定結果のcsv出力
-        print("道路ランク判定結果のcsv出力")
-        df = pd.DataFrame({
-            'road_id' : road_judge_results['road_id'],
-            'road_rank' : road_judge_results['road_rank']  
-            })
-        df.to_csv(os.path.join(result_dir, file[:-4] + "_eval1.csv"), index=False)
-
-        # ポリコンランク判定結果のcsv出力
-        print("ポリゴンランク判定結果のcsv出力")
-        poly_judge_results = { 'road_id':[], 'road_rank':[], 'poly_id':[], 'poly_rank':[], 'poly':[] }
-        for i, road_id in enumerate(road_judge_results['road_id']):
-            road_rank = road_judge_results['road_rank'][i]
-            for j, poly in enumerate(road_judge_results['polys'][i]):
-                poly_rank = road_judge_results['polys_rank'][i][j]
-
-                poly_judge_results['road_id'].append(road_id)
-                poly_judge_results['road_rank'].append(road_rank)
-                poly_judge_results['poly_id'].append(str(j+1))
-                poly_judge_results['poly_rank'].append(poly_rank)
-                poly_judge_results['poly'].append(poly)
-
-        for i, road_id in enumerate(poly_judge_results['road_id']):
-            all_poly_judge_results['file'].append(file)
-            all_poly_judge_results['road_id'].append(road_id)
-            all_poly_judge_results['road_rank'].append(poly_judge_results['road_rank'][i])
-            all_poly_judge_results['poly_id'].append(poly_judge_results['poly_id'][i])
-            all_poly_judge_results['poly_rank'].append(poly_judge_results['poly_rank'][i])
-            all_poly_judge_results['poly_area'].append(poly_judge_results['poly'][i].area) 
+                    poly_judge_results['road_id'].append(road_id)
+                    poly_judge_results['road_rank'].append(road_rank)
+                    poly_judge_results['poly_id'].append(str(j+1))
+                    poly_judge_results['poly_rank'].append(poly_rank)
+                    poly_judge_results['poly'].append(poly)
+
+            # 判定結果の出力（全道路・全ポリゴンのcsvにも追記）
+            writer.write(file, road_judge_results, poly_judge_results)
+
+    # ランクの集計
+    df = pd.DataFrame({'road_rank': writer.road_ranks})
 
-        df = pd.DataFrame({
-            'road_id' : poly_judge_results['road_id'],
-            'road_rank' : poly_judge_results['road_rank'],
-            'poly_id' : poly_judge_results['poly_id'],
-            'poly_rank' : poly_judge_results['poly_rank']
-            })
-        df.to_csv(os.path.join(result_dir, file[:-4] + "_eval2.csv"), index=False)
-
-        # shp出力
-        print("shp出力")
-        write_file(os.path.join(result_dir, file[:-4] + "_eval2.shp"), poly_judge_results)
-
-    # 全道路ランク判定結果のcsv出力
-    df = pd.DataFrame({
-        'file' : all_road_judge_results['file'],
-        'road_id' : all_road_judge_results['road_id'],
-        'road_rank' : all_road_judge_results['road_rank']  
-        })
-    df.to_csv(os.path.join(result_dir, "all_eval1.csv"), index=False)
-    
     # .txtファイルへの書き込み準備
     txt_file_path = os.path.join(result_dir, "result_rank.txt")  # 出力ファイル名
     with open(txt_file_path, "w") as f:  # "w" は書き込みモード
@@ -464,16 +860,10 @@ def main(shp_dir_pred, shp_dir_true, result_dir, city):
         print(rank_counts)
         f.write(f"{rank_counts}\n")  # ファイルにも書き込み
 
-        # 全ポリコンランク判定結果のcsv出力
         df = pd.DataFrame({
-            'file': all_poly_judge_results['file'],
-            'road_id': all_poly_judge_results['road_id'],
-            'road_rank': all_poly_judge_results['road_rank'],
-            'poly_id': all_poly_judge_results['poly_id'],
-            'poly_rank': all_poly_judge_results['poly_rank'],
-            'poly_area': all_poly_judge_results['poly_area']  # 面積を追加
+            'poly_rank': writer.poly_ranks,
+            'poly_area': writer.poly_areas
         })
-        df.to_csv(os.path.join(result_dir, "all_eval2.csv"), index=False)
 
         print(f"ポリゴンランクのカウント")
         f.write("ポリゴンランクのカウント\n")  # ファイルにも書き込み
@@ -499,6 +889,20 @@ def main(shp_dir_pred, shp_dir_true, result_dir, city):
 
     print(f"結果は {txt_file_path} に保存されました。")
 
+    print("差分距離の判定段階毎のポリゴン数")
+    for stage, name in DIFF_STAGES.items():
+        print(f"{name}: {stage_counts[stage]}")
+
+    if idle:
+        print(f"プロセスの待ち時間（実測の処理時間によるシミュレーション）：道路ID順 {idle['fifo']:.2f}秒、コスト順 {idle['cost']:.2f}秒（{idle['fifo'] - idle['cost']:.2f}秒削減）")
+
+    if memo_path is not None:
+        trim_diff_memo(open_diff_memo(memo_path), memo_max_entries)
+
+    if skeleton_stats:
+        print("スケルトン計算の統計")
+        print(skeleton_total)
+
 if __name__ == '__main__':
 
     #city = "hiroshima"
@@ -525,6 +929,15 @@ if __name__ == '__main__':
     shp_dir_pred = os.path.join(data_path, pred_name)
     shp_dir_true = os.path.join(data_path, true_name)
     result_dir = os.path.join(data_path, "qual_eval_result", pred_name)
+    cache_dir = os.path.join("data", "true_cache") # 正解データの読み込み結果のキャッシュフォルダ（Noneの場合はキャッシュしない）
+    skeleton_stats = False # Trueの場合、スケルトン計算のイベント数・処理時間を集計して表示する
+    diff_engine = "skeleton" # 差分距離の算出方式（"skeleton" / "mic" / "raster"）
+    memo_path = None # 差分距離の保存先（例: os.path.join("data", "diff_memo.sqlite")、Noneの場合は保存しない）
+    memo_max_entries = 1000000 # 差分距離の最大保存件数
+    workers = os.cpu_count() # 並列プロセス数（1の場合は逐次処理）
+    streaming = False # Trueの場合、正解は予測shp毎に同名の正解shpと道路IDがまたがる正解shpのみ読み込む（大規模データでのメモリ使用量削減）
+    output_format = "shp" # 予測shp毎の結果の出力形式（"shp" / "gpkg" / "parquet"）
     
-    main(shp_dir_pred, shp_dir_true, result_dir, city)
+    main(shp_dir_pred, shp_dir_true, result_dir, city, cache_dir, skeleton_stats, diff_engine, memo_path, memo_max_entries, workers, streaming,
+         output_format)
     print("Done")
\ No newline at end of file
@@ -1,10 +1,17 @@
 # -*- coding: utf-8 -*-
 import sys
 import os
+import hashlib
+import pickle
+from itertools import chain
+from contextlib import nullcontext
+from multiprocessing import Pool
 import numpy as np
-import shapefile
-from shapely.geometry import shape as Shape
-import geopandas as gpd
+import shapely
+from shapely.strtree import STRtree
+from RoadLoader import (CLASSES, CLASS_INDEX, read_road_pred_columns, read_road_true_columns,
+                        concat_columns, columns_to_records, load_record_index, records_for_ids,
+                        read_road_true_records, group_by_id, true_id_field)
 #import polyskel
 #from PIL import Image, ImageDraw
 #import cv2
@@ -22,6 +29,9 @@ import geopandas as gpd
 
 np.set_printoptions(precision=4, floatmode='fixed', suppress=True)
 
+# 道路毎のconfusion matrixの保存形式バージョン（算出方法を変更した場合は更新する）
+ROAD_STORE_VERSION = 1
+
 def calculate_confusision_matrix(data_pred, data_true):
     conf_mx = []
     for pred_cls in ['1000', '1020', '2000', '3000']:
@@ -42,22 +52,235 @@ def calculate_confusision_matrix(data_pred, data_true):
     return conf_mx
 
 
+def calculate_confusion_matrix_strtree(data_pred, data_true):
+    """
+    calculate_confusision_matrixのSTRtree版（結果は同一）
+    正解ポリゴンの空間インデックスを1つ作成し、bboxが重なる候補ペアのみを1回の走査で16セルに集計する
+    """
+    conf_mx = [[0.0 for _ in CLASSES] for _ in CLASSES]
+
+    elems_true = [elem for elem in data_true if elem['class'] in CLASS_INDEX]
+    if not elems_true:
+        return conf_mx
+    polys_true = np.array([elem['poly'] for elem in elems_true], dtype=object)
+    cls_true = [CLASS_INDEX[elem['class']] for elem in elems_true]
+
+    tree = STRtree(polys_true)
+    shapely.prepare(polys_true)
+
+    for elem in data_pred:
+        pred_idx = CLASS_INDEX.get(elem['class'])
+        if pred_idx is None:
+            continue
+        poly_pred = elem['poly']
+        # 元の関数と同じ加算順になるよう正解の並び順で処理
+        for true_idx in np.sort(tree.query(poly_pred)):
+            poly_true = polys_true[true_idx]
+            try:
+                if poly_true.intersects(poly_pred):
+                    conf_mx[pred_idx][cls_true[true_idx]] += poly_pred.intersection(poly_true).area
+            except Exception as e:
+                print(e)
+
+    shapely.destroy_prepared(polys_true)
+    return conf_mx
+
+
+def to_arrays(data, id_codes):
+    """
+    [{"id", "class", "poly"}]形式を列指向(struct-of-arrays)形式に変換する
+    Arguments:
+        data: [{"id":string, "class":string, "poly":polygon}]
+        id_codes: {道路ID: 整数コード}。未登録のIDは追記される（予測・正解で共有する）
+    Returns:
+        dict: {"poly": geometry配列, "class": int8配列（CLASSESの添字、対象外は-1）, "id": 道路IDコード配列}
+    """
+    polys = np.empty(len(data), dtype=object)
+    polys[:] = [elem['poly'] for elem in data]
+    cls = np.fromiter((CLASS_INDEX.get(elem['class'], -1) for elem in data), dtype=np.int8, count=len(data))
+    ids = np.fromiter((id_codes.setdefault(elem['id'], len(id_codes)) for elem in data), dtype=np.int64, count=len(data))
+    return {"poly": polys, "class": cls, "id": ids}
+
+
+def encode_ids(columns, id_codes):
+    """
+    RoadLoaderの列指向形式の道路IDを整数コードに変換する（to_arraysと同じ形式を返す）
+    """
+    ids = np.fromiter((id_codes.setdefault(id, len(id_codes)) for id in columns['id'].tolist()), dtype=np.int64, count=len(columns['id']))
+    return {"poly": columns['poly'], "class": columns['class'], "id": ids}
+
+
+def calculate_confusion_matrices_array(arrays_pred, arrays_true, n_ids):
+    """
+    列指向形式のデータから道路ID毎のconfusion matrixを一括算出する
+    候補ペアはSTRtreeで一度に抽出し、重なり面積はshapelyの配列演算で計算してnp.add.atで集計する
+    Returns:
+        ndarray: (n_ids, 4, 4) 道路IDコード毎のconfusion matrix
+    """
+    conf_mxs = np.zeros((n_ids, len(CLASSES), len(CLASSES)), np.float64)
+    if len(arrays_pred['poly']) == 0 or len(arrays_true['poly']) == 0:
+        return conf_mxs
+
+    # bboxが重なるペアのうち、同一道路IDかつ評価対象クラスのものに限定
+    tree = STRtree(arrays_true['poly'])
+    idx_pred, idx_true = tree.query(arrays_pred['poly'])
+    keep = ((arrays_pred['id'][idx_pred] == arrays_true['id'][idx_true])
+            & (arrays_pred['class'][idx_pred] >= 0) & (arrays_true['class'][idx_true] >= 0))
+    # 予測・正解の並び順に集計し、分割方法によらず加算順を一定にする
+    order = np.lexsort((idx_true[keep], idx_pred[keep]))
+    idx_pred = idx_pred[keep][order]
+    idx_true = idx_true[keep][order]
+
+    polys_pred = arrays_pred['poly'][idx_pred]
+    polys_true = arrays_true['poly'][idx_true]
+    try:
+        hit = shapely.intersects(polys_pred, polys_true)
+        areas = np.zeros(len(idx_pred), np.float64)
+        areas[hit] = shapely.area(shapely.intersection(polys_pred[hit], polys_true[hit]))
+    except Exception:
+        # 不正なジオメトリを含む場合はペア毎に計算し、失敗したペアは0とする
+        areas = np.zeros(len(idx_pred), np.float64)
+        for i, (poly_pred, poly_true) in enumerate(zip(polys_pred, polys_true)):
+            try:
+                if poly_pred.intersects(poly_true):
+                    areas[i] = poly_pred.intersection(poly_true).area
+            except Exception as e:
+                print(e)
+
+    np.add.at(conf_mxs, (arrays_pred['id'][idx_pred], arrays_pred['class'][idx_pred], arrays_true['class'][idx_true]), areas)
+    return conf_mxs
+
+
+def report_missing_ids(id_count, poly_count):
+    """
+    予測の無い正解道路IDの報告
+    """
+    if id_count:
+        print(f"予測の無い正解道路ID数：{id_count}, ポリゴン数：{poly_count}")
+
+
+# confusion matrix算出方式（"array"はevaluate_roads内で列指向形式により一括算出）
+CONFUSION_ENGINES = {
+    "loop": calculate_confusision_matrix,
+    "strtree": calculate_confusion_matrix_strtree,
+}
+
+
+def road_digest(check_pred, check_true):
+    """
+    道路IDの予測・正解ポリゴン（クラスとWKB）のハッシュ値
+    """
+    h = hashlib.blake2b(digest_size=16)
+    for data in (check_pred, check_true):
+        for elem in data:
+            h.update(str(elem['class']).encode("utf-8"))
+            h.update(shapely.to_wkb(elem['poly']))
+        h.update(b"|")
+    return h.digest()
+
+
+def load_road_store(store_path):
+    """
+    道路毎のconfusion matrixの保存データの読み込み
+    Returns:
+        dict: {(予測ファイル名 or None, id): (ハッシュ値, confusion matrix)}
+    """
+    if store_path is None or not os.path.exists(store_path):
+        return {}
+    try:
+        with open(store_path, "rb") as f:
+            store = pickle.load(f)
+        if store.get("version") == ROAD_STORE_VERSION:
+            return store["roads"]
+    except Exception as e:
+        print("道路毎の算出結果の読み込みに失敗:", store_path, e)
+    return {}
+
+
+def save_road_store(store_path, roads):
+    """
+    道路毎のconfusion matrixの保存（一時ファイルに書き込んでから置き換える）
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(store_path)), exist_ok=True)
+    tmp_path = store_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        pickle.dump({"version": ROAD_STORE_VERSION, "roads": roads}, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, store_path)
+
+
+def evaluate_roads_incremental(groups_pred, groups_true, engine, workers, store, new_store, prefix=None, pool=None):
+    """
+    前回の算出結果から予測・正解ポリゴンに変更のあった道路IDのみconfusion matrixを再計算する
+    Arguments:
+        store: 前回の保存データ {(prefix, id): (ハッシュ値, confusion matrix)}
+        new_store: 今回の結果の格納先（storeと同じ形式）
+        prefix: 保存データのキーに付加する値（ファイル毎に処理する場合は予測ファイル名）
+        pool: 並列処理用のプロセスプール（Noneの場合は逐次処理）
+    Returns:
+        dict: {id: confusion matrix}（groups_predの順）
+    """
+    digests = {}
+    changed_pred = {}
+    for check_id, check_pred in groups_pred.items():
+        digests[check_id] = road_digest(check_pred, groups_true.get(check_id, []))
+        cached = store.get((prefix, check_id))
+        if cached is None or cached[0] != digests[check_id]:
+            changed_pred[check_id] = check_pred
+    changed_true = {check_id: groups_true[check_id] for check_id in changed_pred if check_id in groups_true}
+    print(f"再計算する道路ID数：{len(changed_pred)} / {len(groups_pred)}")
+
+    if pool is not None:
+        changed = evaluate_roads_parallel(changed_pred, changed_true, engine, workers, pool)
+    else:
+        changed = evaluate_roads(changed_pred, changed_true, engine)
+
+    result = {}
+    for check_id in groups_pred:
+        if check_id in changed:
+            result[check_id] = np.array(changed[check_id], np.float64)
+        else:
+            result[check_id] = store[(prefix, check_id)][1]
+        new_store[(prefix, check_id)] = (digests[check_id], result[check_id])
+    return result
+
+
+def per_road_scores(roads):
+    """
+    保存データの道路毎のconfusion matrixからIoU・F1をまとめて算出する
+    予測・正解ともに面積が0のクラスはNaNとする
+    Returns:
+        keys: 保存データのキーのリスト
+        IoU: ([n_road, n_c]) 道路毎のIoU
+        F1: ([n_road, n_c]) 道路毎のF1
+    """
+    keys = list(roads)
+    if not keys:
+        return keys, np.empty((0, len(CLASSES))), np.empty((0, len(CLASSES)))
+    conf_mxs = np.stack([roads[key][1] for key in keys])
+    IoU = IoU_from_confusions(conf_mxs)
+    F1, _, _ = FScore_from_confusions(conf_mxs)
+    absent = (np.sum(conf_mxs, axis=-2) + np.sum(conf_mxs, axis=-1)) == 0
+    IoU[absent] = np.nan
+    F1[absent] = np.nan
+    return keys, IoU, F1
+
+
 def IoU_from_confusions(confusions):
     """
     Computes IoU from confusion matrices.
-    :param confusions: ([n_c, n_c], np.float32). n_c = number of classes.
+    :param confusions: ([..., n_c, n_c], np.float32). n_c = number of classes.
                      GT
                 -----------
                 | TP | FP |
            PRED -----------
                 | FN | TN |
                 -----------
-    :return: ([n_c] np.float32) IoU score
+    :return: ([..., n_c] np.float32) IoU score
     """
 
-    TP = np.diagonal(confusions)
-    TP_plus_FN = np.sum(confusions, axis=0)
-    TP_plus_FP = np.sum(confusions, axis=1)
+    TP = np.diagonal(confusions, axis1=-2, axis2=-1)
+    TP_plus_FN = np.sum(confusions, axis=-2)
+    TP_plus_FP = np.sum(confusions, axis=-1)
 
     IoU = TP / (TP_plus_FP + TP_plus_FN - TP + 1e-6)
     return IoU
@@ -66,19 +289,19 @@ def IoU_from_confusions(confusions):
 def FScore_from_confusions(confusions):
     """
     Computes FScore from confusion matrices.
-    :param confusions: ([n_c, n_c], np.float32). n_c = number of classes.
+    :param confusions: ([..., n_c, n_c], np.float32). n_c = number of classes.
                      GT
                 -----------
                 | TP | FP |
            PRED -----------
                 | FN | TN |
                 -----------
-    :return: ([n_c] np.float32) F1-score, precision, recall
+    :return: ([..., n_c] np.float32) F1-score, precision, recall
     """
 
-    TP = np.diagonal(confusions)
-    TP_plus_FN = np.sum(confusions, axis=0)
-    TP_plus_FP = np.sum(confusions, axis=1)
+    TP = np.diagonal(confusions, axis1=-2, axis2=-1)
+    TP_plus_FN = np.sum(confusions, axis=-2)
+    TP_plus_FP = np.sum(confusions, axis=-1)
 
     precision = TP / (TP_plus_FP + 1e-6)
     recall = TP / (TP_plus_FN + 1e-6)
@@ -90,193 +313,216 @@ def read_road_pred(shp_path):
     """
     予測シェープファイル読み込み機能
     """
+    return columns_to_records(read_road_pred_columns(shp_path))
 
-    def convert_class(set_class, set_intersec):
-        """
-        予測シェープファイルから正解シェープファイルのclass形式に変換
-        """
-        if set_class == 1:
-            if set_intersec == 1:
-                # 車道交差部
-                return 1020
-            else:
-                # 車道部
-                return 1000
-        elif set_class == 2:
-            # 歩道部
-            return 2000
-        elif set_class == 3:
-            # 島部
-            return 3000
-        else:
-            return set_class
+def read_road_true(shp_path, city, encoding="Shift-JIS", epsg=None, cache_dir=None):
+    """
+    正解シェープファイル読み込み機能
 
+    Parameters:
+        shp_path (str): シェープファイルのパス
+        city (str): 都市名
+        encoding (str): ファイルのエンコーディング（デフォルト: "Shift-JIS"）
+        epsg (int or None): 変換先のEPSGコード（例: '3857'）。Noneの場合は変換しない
+        cache_dir (str or None): 読み込み結果のキャッシュフォルダ。Noneの場合はキャッシュしない
+    """
+    return columns_to_records(read_road_true_columns(shp_path, true_id_field(city), epsg, encoding, cache_dir))
 
-    shx_path = shp_path[:-4] + ".shx"
-    dbf_path = shp_path[:-4] + ".dbf"
+def evaluate_roads(groups_pred, groups_true, engine):
+    """
+    道路ID毎のconfusion matrix算出
+    Arguments:
+        groups_pred: 予測データ {id: [{"id":string, "class":string, "poly":polygon}]}
+        groups_true: 正解データ {id: [{"id":string, "class":string, "poly":polygon}]}
+        engine: confusion matrix算出方式
+    Returns:
+        dict: {id: confusion matrix}（groups_predの順）
+    """
+    if engine == "array":
+        # 列指向形式で一括算出（予測を先に変換するため、予測の道路IDはコード0から連番）
+        id_codes = {}
+        arrays_pred = to_arrays(list(chain.from_iterable(groups_pred.values())), id_codes)
+        check_true = [groups_true[check_id] for check_id in groups_pred if check_id in groups_true]
+        arrays_true = to_arrays(list(chain.from_iterable(check_true)), id_codes)
+        conf_mxs = calculate_confusion_matrices_array(arrays_pred, arrays_true, len(id_codes))
+        return {check_id: conf_mxs[code] for code, check_id in enumerate(groups_pred)}
+
+    calc_conf_mx = CONFUSION_ENGINES[engine]
+    result = {}
+    for check_id, check_pred in groups_pred.items():
+        # 道路ID単位の処理
+        check_true = groups_true.get(check_id, [])
+        result[check_id] = calc_conf_mx(check_pred, check_true)
+    return result
 
-    shp_file = open(shp_path.encode("utf-8"), "rb")
-    shx_file = open(shx_path.encode("utf-8"), "rb")
-    dbf_file = open(dbf_path.encode("utf-8"), "rb")
 
-    data = []
-    with shapefile.Reader(shp=shp_file, shx=shx_file, dbf=dbf_file, encoding='Shift-JIS') as sf:
-        for sr in sf.iterShapeRecords(): 
-            id = sr.record["lod1_id"]
-            cls = sr.record["class"]
-            intersec = sr.record["is_in_inte"]
+def _evaluate_roads_chunk(args):
+    """
+    並列処理用：道路IDの部分集合についてconfusion matrixを算出
+    """
+    groups_pred, groups_true, engine = args
+    return evaluate_roads(groups_pred, groups_true, engine)
 
-            geom = Shape(sr.shape.__geo_interface__)
 
-            data.append({
-                "id" : id,
-                "class": str(convert_class(cls, intersec)),
-                "poly": geom
-                })
+def evaluate_roads_parallel(groups_pred, groups_true, engine, workers, pool):
+    """
+    道路IDをワーカー数に応じて分割し、プロセス並列でconfusion matrixを算出
+    道路単位の結果をgroups_predの順に戻すため、合計値は逐次処理と同一になる
+    pool: 実行全体で共通のプロセスプール（mainで作成）
+    """
+    ids = list(groups_pred)
+    chunk_count = min(len(ids), workers * 4)
+    if chunk_count == 0:
+        return {}
+    chunk_size = -(-len(ids) // chunk_count)
+    chunks = []
+    for start in range(0, len(ids), chunk_size):
+        chunk_ids = ids[start:start + chunk_size]
+        chunks.append((
+            {check_id: groups_pred[check_id] for check_id in chunk_ids},
+            {check_id: groups_true[check_id] for check_id in chunk_ids if check_id in groups_true},
+            engine,
+        ))
 
-    shp_file.close()
-    shx_file.close()
-    dbf_file.close()
+    result = {}
+    for partial in pool.map(_evaluate_roads_chunk, chunks):
+        result.update(partial)
+    return result
 
-    return data
 
-def read_road_true(shp_path, city, encoding="Shift-JIS"):
+def evaluate_all(shp_path_pred, shp_path_true, city, epsg, encoding, engine, workers, cache_dir=None, store=None, new_store=None, pool=None):
     """
-    正解シェープファイル読み込み機能
+    全ての予測・正解シェープファイルを読み込んでconfusion matrixを算出する
+    Returns:
+        ndarray: (4, 4) confusion matrix
     """
-    shx_path = shp_path[:-4] + ".shx"
-    dbf_path = shp_path[:-4] + ".dbf"
-
-    shp_file = open(shp_path.encode("utf-8"), "rb")
-    shx_file = open(shx_path.encode("utf-8"), "rb")
-    dbf_file = open(dbf_path.encode("utf-8"), "rb")
-    #print("shp_path:",shp_path)
-    data = []
-    with shapefile.Reader(shp=shp_file, shx=shx_file, dbf=dbf_file, encoding=encoding) as sf:
-        for sr in sf.iterShapeRecords(): 
-            if city == "sendai" or city == "mitaka":
-                id = sr.record["gml_id"]
-            else:
-                id = sr.record["id"]
-            cls = sr.record["class"]
-
-            if str(cls) not in ['1000', '1020', '2000', '3000']:
-                continue
-
-            if sr.shape is None or sr.shape.shapeType == 0:  # shapeType 0 は NULL
-                print("NULL shape found:", sr.shape)
-                continue
-            geom = Shape(sr.shape.__geo_interface__)
-
-            data.append({
-                "id" : id,
-                "class": str(cls),
-                "poly": geom
-                })
-
-    shp_file.close()
-    shx_file.close()
-    dbf_file.close()
-
-    return data
-
-def read_road_true_gpd(shp_path, city, epsg=None, encoding="Shift-JIS"):
-    """
-    正解シェープファイル読み込み機能（GeoPandas版）
-    
-    Parameters:
-        shp_path (str): シェープファイルのパス
-        city (str): 都市名
-        epsg (int or None): 変換先のEPSGコード（例: '3857'）。Noneの場合は変換しない
-        encoding (str): ファイルのエンコーディング（デフォルト: "Shift-JIS"）
-    
+    # 列指向形式で読み込み
+    columns_pred = concat_columns([read_road_pred_columns(shp_path) for shp_path in shp_path_pred])
+    columns_true = concat_columns([read_road_true_columns(shp_path, true_id_field(city), epsg, encoding, cache_dir) for shp_path in shp_path_true])
+
+    if engine == "array" and pool is None and store is None:
+        # 列指向形式のまま全道路を一括算出（予測を先に変換するため、予測の道路IDはコード0から連番）
+        id_codes = {}
+        arrays_pred = encode_ids(columns_pred, id_codes)
+        pred_id_count = len(id_codes)
+        arrays_true = encode_ids(columns_true, id_codes)
+
+        # 予測の無い正解道路IDの報告
+        missing = arrays_true['id'] >= pred_id_count
+        report_missing_ids(len(id_codes) - pred_id_count, int(missing.sum()))
+
+        conf_mxs = calculate_confusion_matrices_array(arrays_pred, arrays_true, len(id_codes))
+
+        # F値計算
+        conf_mx = np.zeros((4,4), np.float64)
+        for value in conf_mxs[:pred_id_count]:
+            conf_mx += value
+        return conf_mx
+
+    # 予測データ：[{"id":string, "class":string, "poly":polygon}]
+    data_pred = columns_to_records(columns_pred)
+    # 正解データ：[{"id":string, "class":string, "poly":polygon}]
+    data_true = columns_to_records(columns_true)
+
+    # 道路ID単位にグループ化
+    groups_pred = group_by_id(data_pred)
+    groups_true = group_by_id(data_true)
+
+    # 予測の無い正解道路IDの報告
+    missing_ids = groups_true.keys() - groups_pred.keys()
+    report_missing_ids(len(missing_ids), sum(len(groups_true[check_id]) for check_id in missing_ids))
+
+    # confusion matrix算出
+    if store is not None:
+        result = evaluate_roads_incremental(groups_pred, groups_true, engine, workers, store, new_store, pool=pool)
+    elif pool is not None:
+        result = evaluate_roads_parallel(groups_pred, groups_true, engine, workers, pool)
+    else:
+        result = evaluate_roads(groups_pred, groups_true, engine)
+
+    # F値計算
+    conf_mx = np.zeros((4,4), np.float64)
+    for key, value in result.items():
+        conf_mx += np.array(value)
+    return conf_mx
+
+
+def evaluate_streaming(shp_path_pred, shp_path_true, city, epsg, encoding, engine, workers, store=None, new_store=None, pool=None):
+    """
+    予測シェープファイルを1ファイルずつ処理し、confusion matrixを逐次加算する
+    正解は処理中のファイルに含まれる道路IDのレコードのみ読み込むため、メモリ使用量は最大のファイル分に抑えられる
     Returns:
-        list[dict]: シェープファイルのデータを格納したリスト
+        ndarray: (4, 4) confusion matrix
     """
-    # シェープファイルをGeoPandasで読み込む
-    gdf = gpd.read_file(shp_path, encoding=encoding)
-    
-    # EPSGコードが指定されていれば座標系を変換
-    if epsg:
-        gdf = gdf.to_crs(epsg = epsg)
-    
-    data = []
-    
-    # 必要なフィールドを抽出
-    for _, row in gdf.iterrows():
-        # id フィールドの取得
-        if city in ["sendai", "mitaka"]:
-            id = row.get("gml_id")
+    # 正解データのレコード索引（道路ID→レコード、サイドカーファイルに保存）
+    true_indexes = {shp_path: load_record_index(shp_path, true_id_field(city), encoding) for shp_path in shp_path_true}
+
+    conf_mx = np.zeros((4,4), np.float64)
+    checked_ids = set()
+    for shp_path in shp_path_pred:
+        groups_pred = group_by_id(read_road_pred(shp_path))
+        checked_ids.update(groups_pred)
+
+        # 対象道路IDの正解レコードのみ読み込む
+        data_true = []
+        for path, index in true_indexes.items():
+            record_nums = records_for_ids(index, groups_pred)
+            if len(record_nums):
+                data_true += columns_to_records(read_road_true_records(path, record_nums, index, epsg))
+        groups_true = group_by_id(data_true)
+
+        if store is not None:
+            prefix = os.path.basename(shp_path)
+            result = evaluate_roads_incremental(groups_pred, groups_true, engine, workers, store, new_store, prefix, pool)
+        elif pool is not None:
+            result = evaluate_roads_parallel(groups_pred, groups_true, engine, workers, pool)
         else:
-            id = row.get("id")
-        
-        # class フィールドの取得とフィルタリング
-        cls = row.get("class")
-        if str(cls) not in ['1000', '1020', '2000', '3000']:
-            continue
-        
-        # geometry の取得と Shapely 形式への変換
-        geom = row.geometry
-        if geom is None or geom.is_empty:
-            print("NULL geometry found:", row.geometry)
-            continue
-        
-        # 必要な情報をリストに追加
-        data.append({
-            "id": id,
-            "class": str(cls),
-            "poly": Shape(geom)  # Shapely 形式に変換
-        })
-    
-    return data
+            result = evaluate_roads(groups_pred, groups_true, engine)
+        for value in result.values():
+            conf_mx += np.array(value)
+
+    # 予測の無い正解道路IDの報告
+    missing_ids = set()
+    missing_count = 0
+    for index in true_indexes.values():
+        for check_id, record_nums in index["id_records"].items():
+            if check_id not in checked_ids:
+                missing_ids.add(check_id)
+                missing_count += len(record_nums)
+    report_missing_ids(len(missing_ids), missing_count)
 
-def main(shp_dir_pred, shp_dir_true, city, epsg = None):
+    return conf_mx
+
+
+def main(shp_dir_pred, shp_dir_true, city, epsg = None, engine = "strtree", workers = 1, streaming = False, cache_dir = None, store_path = None):
     shp_path_pred = [os.path.join(shp_dir_pred, file) for file in os.listdir(shp_dir_pred) if file[-4:]=='.shp']
     shp_path_true = [os.path.join(shp_dir_true, file) for file in os.listdir(shp_dir_true) if file[-4:]=='.shp']
 
-    # 予測データ：[{"id":string, "class":string, "poly":polygon}]
-    data_pred = []
-    for shp_path in shp_path_pred:
-        data_pred += read_road_pred(shp_path)     
-        
-    # 正解データ：[{"id":string, "class":string, "poly":polygon}]
-    data_true = []
     encoding = "CP932"#"Shift-JIS"
     if city=="gifu" or city=="kaga":
         encoding = "utf-8"
-    if epsg is not None:
-        for shp_path in shp_path_true:
-            data_true += read_road_true_gpd(shp_path, city, epsg, encoding)
-    else:
-        for shp_path in shp_path_true:
-            data_true += read_road_true(shp_path, city, encoding)
 
-    # 判定対象建物ID一覧
-    ids = list(dict.fromkeys([d.get('id') for d in data_pred]))
+    # 道路毎のconfusion matrixの前回結果（指定時は変更のあった道路のみ再計算）
+    store = load_road_store(store_path) if store_path is not None else None
+    new_store = {}
 
-    # confusion matrix算出
-    result = {}
-    for check_id in ids:
-        # 建物ID単位の処理
-        #print(check_id)
-        check_pred = []
-        check_true = []
-
-        for data in data_pred:
-            if data.get('id') == check_id:
-                check_pred.append(data)
+    # 全ファイル共通のプロセスプール（workersが1の場合は逐次処理）
+    with Pool(workers) if workers > 1 else nullcontext() as pool:
+        if streaming:
+            # 予測ファイル単位の逐次処理
+            conf_mx = evaluate_streaming(shp_path_pred, shp_path_true, city, epsg, encoding, engine, workers, store, new_store, pool)
+        else:
+            conf_mx = evaluate_all(shp_path_pred, shp_path_true, city, epsg, encoding, engine, workers, cache_dir, store, new_store, pool)
 
-        for data in data_true:
-            if data.get('id') == check_id:
-                check_true.append(data)
+    if store_path is not None:
+        save_road_store(store_path, new_store)
 
-        conf_mx = calculate_confusision_matrix(check_pred, check_true)
-        result[check_id] = conf_mx
+        # 道路毎のIoU・F1の分布
+        _, road_IoU, road_F1 = per_road_scores(new_store)
+        if len(road_IoU):
+            print("道路毎のIoU（25/50/75パーセンタイル）:\n", np.nanpercentile(road_IoU, [25, 50, 75], axis=0))
+            print("道路毎のF1（25/50/75パーセンタイル）:\n", np.nanpercentile(road_F1, [25, 50, 75], axis=0))
 
-    # F値計算
-    conf_mx = np.zeros((4,4), np.float64)
-    for key, value in result.items():
-        conf_mx += np.array(value)
     print("Confusion Matrix:\n", conf_mx)
 
     # IOU計算
@@ -293,6 +539,11 @@ def main(shp_dir_pred, shp_dir_true, city, epsg = None):
 if __name__ == '__main__':
 
     epsg=None
+    engine = "strtree" # confusion matrix算出方式（"loop" / "strtree" / "array"）
+    workers = os.cpu_count() # 並列プロセス数（1の場合は逐次処理）
+    streaming = False # Trueの場合は予測ファイル毎に逐次処理し、メモリ使用量を抑える
+    cache_dir = "./true_cache" # 正解データの読み込み結果のキャッシュフォルダ（Noneの場合はキャッシュしない）
+    store_path = None # 道路毎のconfusion matrixの保存先（例: "./quant_store/hiroshima.pkl"）。指定時は変更のあった道路のみ再計算
 
     shp_dir_pred = "./hiroshima/AAS2023ckpt_vectorized"
     shp_dir_true = "./hiroshima/true_v2.4" 
@@ -317,5 +568,5 @@ if __name__ == '__main__':
     #city = "kaga"
     
         
-    main(shp_dir_pred, shp_dir_true, city, epsg)
+    main(shp_dir_pred, shp_dir_true, city, epsg, engine, workers, streaming, cache_dir, store_path)
     print(f"{city} Done")
\ No newline at end of file
@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+import os
+import csv
+import json
+import shutil
+from itertools import repeat
+import numpy as np
+import pandas as pd
+import pyogrio
+import shapefile
+import shapely
+from pyproj import CRS
+from RoadLoader import read_crs
+
+# 評価結果の出力形式（gpkg・parquetは穴を含むポリゴンをそのまま出力し、座標系は予測shpの.prjを引き継ぐ）
+#   shp: 予測shp毎に_eval1.csv・_eval2.csv・_eval2.shpを出力（従来形式）
+#   gpkg: 予測shp毎のレイヤーを1つのGeoPackageに出力
+#   parquet: 全予測shpのポリゴンを1つのGeoParquetに出力（file列で区別）
+RESULT_FORMATS = ("shp", "gpkg", "parquet")
+RESULT_CONTAINERS = {"gpkg": "qual_eval2.gpkg", "parquet": "qual_eval2.parquet"}
+POLY_FIELDS = ['road_id', 'road_rank', 'poly_id', 'poly_rank']
+# shapely.get_type_idの値とGeoPackage・GeoParquetのジオメトリタイプ名
+GEOMETRY_TYPE_NAMES = {
+    0: "Point", 1: "LineString", 2: "LineString", 3: "Polygon",
+    4: "MultiPoint", 5: "MultiLineString", 6: "MultiPolygon", 7: "GeometryCollection",
+}
+
+
+def exterior_coords(polys):
+    """
+    ポリゴン毎の外周座標のリストのリスト（shapelyからまとめて取り出す）
+    MultiPolygonは構成ポリゴン毎の外周をそれぞれ1つのパートとする
+    """
+    polys = np.asarray(polys, dtype=object)
+    parts, index = shapely.get_parts(polys, return_index=True)
+    rings = shapely.get_exterior_ring(parts)
+    counts = shapely.get_num_coordinates(rings)
+    coords = np.split(shapely.get_coordinates(rings), np.cumsum(counts)[:-1]) if len(rings) else []
+    result = [[] for _ in polys]
+    for i, ring in zip(index.tolist(), coords):
+        result[i].append(ring.tolist())
+    return result
+
+
+def write_file(shp_path, poly_judge_results):
+    """
+    ポリゴンランク判定結果のshp出力（外周のみ、MultiPolygonは複数パート）
+    """
+    shx_path = shp_path[:-4] + ".shx"
+    dbf_path = shp_path[:-4] + ".dbf"
+
+    shp_file = open(shp_path.encode("utf-8"), "wb")
+    shx_file = open(shx_path.encode("utf-8"), "wb")
+    dbf_file = open(dbf_path.encode("utf-8"), "wb")
+
+    with shapefile.Writer(
+        shp=shp_file, shx=shx_file, dbf=dbf_file,
+        encoding='Shift-JIS', shapeType=shapefile.POLYGON) as file:
+
+        # 属性情報の設定
+        file.field(name='road_id', fieldType='C')    # テキスト型のroad_id属性
+        file.field(name='road_rank', fieldType='C')  # テキスト型のroad_rank属性
+        file.field(name='poly_id', fieldType='C')    # テキスト型のpoly_id属性
+        file.field(name='poly_rank', fieldType='C')  # テキスト型のpoly_rank属性
+
+        # レコードとポリゴン情報の追加
+        for record, rings in zip(zip(*(poly_judge_results[name] for name in POLY_FIELDS)),
+                                 exterior_coords(poly_judge_results['poly'])):
+            file.record(*record)
+            file.poly(rings)
+
+    shp_file.close()
+    shx_file.close()
+    dbf_file.close()
+
+
+def geometry_types(polys):
+    """
+    ジオメトリに含まれるタイプ名（昇順、欠損値は除く）
+    """
+    type_ids = np.unique(shapely.get_type_id(polys))
+    return sorted({GEOMETRY_TYPE_NAMES[type_id] for type_id in type_ids.tolist() if type_id >= 0})
+
+
+def _layer_geometry_type(types):
+    """
+    GeoPackageのレイヤーのジオメトリタイプ
+    PolygonとMultiPolygonが混在する場合はMultiPolygonに揃え、それ以外の混在はUnknownとする
+    Returns:
+        (ジオメトリタイプ, MultiPolygonに揃えるか)
+    """
+    if not types:
+        return "Polygon", False
+    if len(types) == 1:
+        return types[0], False
+    if set(types) == {"Polygon", "MultiPolygon"}:
+        return "MultiPolygon", True
+    return "Unknown", False
+
+
+def _geoparquet_metadata(types, crs):
+    """
+    GeoParquetのメタデータ
+    crs: 座標系（PROJJSON）。Noneの場合は未定義とする
+    """
+    return json.dumps({
+        "version": "1.0.0",
+        "primary_column": "geometry",
+        "columns": {"geometry": {"encoding": "WKB", "geometry_types": types, "crs": crs}},
+    })
+
+
+class ResultWriter:
+    """
+    定性評価結果の書き出し
+    予測shp毎の結果をwriteで受け取った時点で書き出し、全ファイル分のcsv(all_eval1.csv・all_eval2.csv)にも追記する
+    集計用に全ファイル分の道路ランク・ポリゴンランク・ポリゴン面積のみ保持する
+    shp_dir_pred: 予測shp格納フォルダ（座標系を引き継ぐ。Noneの場合は座標系を出力しない）
+    """
+
+    def __init__(self, result_dir, output_format="shp", shp_dir_pred=None):
+        if output_format not in RESULT_FORMATS:
+            raise ValueError(f"未対応の出力形式です: {output_format}（{' / '.join(RESULT_FORMATS)}）")
+        self.result_dir = result_dir
+        self.output_format = output_format
+        self.shp_dir_pred = shp_dir_pred
+        self.road_ranks = []
+        self.poly_ranks = []
+        self.poly_areas = []
+
+        self._eval1 = open(os.path.join(result_dir, "all_eval1.csv"), "w", encoding="utf-8", newline="")
+        self._eval2 = open(os.path.join(result_dir, "all_eval2.csv"), "w", encoding="utf-8", newline="")
+        self._eval1_csv = csv.writer(self._eval1, lineterminator="\n")
+        self._eval2_csv = csv.writer(self._eval2, lineterminator="\n")
+        self._eval1_csv.writerow(['file', 'road_id', 'road_rank'])
+        self._eval2_csv.writerow(['file', 'road_id', 'road_rank', 'poly_id', 'poly_rank', 'poly_area'])
+
+        self._container = None
+        if output_format in RESULT_CONTAINERS:
+            self._container = os.path.join(result_dir, RESULT_CONTAINERS[output_format])
+        self._parquet = None
+        self._parquet_types = set()
+        self._parquet_crs = set()
+
+    def write(self, file, road_judge_results, poly_judge_results):
+        """
+        予測shp1ファイル分の結果の書き出し
+        Arguments:
+            road_judge_results: {'road_id':[], 'road_rank':[]}
+            poly_judge_results: {'road_id':[], 'road_rank':[], 'poly_id':[], 'poly_rank':[], 'poly':[]}
+        """
+        polys = np.array(poly_judge_results['poly'], dtype=object)
+        areas = shapely.area(polys).tolist()
+
+        self._eval1_csv.writerows(zip(repeat(file), road_judge_results['road_id'], road_judge_results['road_rank']))
+        self._eval2_csv.writerows(zip(repeat(file), *(poly_judge_results[name] for name in POLY_FIELDS), areas))
+        self.road_ranks.extend(road_judge_results['road_rank'])
+        self.poly_ranks.extend(poly_judge_results['poly_rank'])
+        self.poly_areas.extend(areas)
+
+        crs = None
+        if self.shp_dir_pred is not None:
+            crs = read_crs(os.path.join(self.shp_dir_pred, file))
+
+        if self.output_format == "shp":
+            self._write_shp(file, road_judge_results, poly_judge_results)
+        elif self.output_format == "gpkg":
+            self._write_gpkg(file, poly_judge_results, polys, crs)
+        else:
+            self._write_parquet(file, poly_judge_results, polys, crs)
+
+    def _write_shp(self, file, road_judge_results, poly_judge_results):
+        # 道路ランク判定結果のcsv出力
+        print("道路ランク判定結果のcsv出力")
+        df = pd.DataFrame({
+            'road_id' : road_judge_results['road_id'],
+            'road_rank' : road_judge_results['road_rank']
+            })
+        df.to_csv(os.path.join(self.result_dir, file[:-4] + "_eval1.csv"), index=False)
+
+        # ポリコンランク判定結果のcsv出力
+        print("ポリゴンランク判定結果のcsv出力")
+        df = pd.DataFrame({name: poly_judge_results[name] for name in POLY_FIELDS})
+        df.to_csv(os.path.join(self.result_dir, file[:-4] + "_eval2.csv"), index=False)
+
+        # shp出力
+        print("shp出力")
+        write_file(os.path.join(self.result_dir, file[:-4] + "_eval2.shp"), poly_judge_results)
+        if self.shp_dir_pred is not None:
+            prj_path = os.path.join(self.shp_dir_pred, file[:-4] + ".prj")
+            if os.path.exists(prj_path):
+                shutil.copyfile(prj_path, os.path.join(self.result_dir, file[:-4] + "_eval2.prj"))
+
+    def _write_gpkg(self, file, poly_judge_results, polys, crs):
+        # 予測shp毎のレイヤーとして追加
+        print("gpkg出力:", file[:-4])
+        geometry_type, promote_to_multi = _layer_geometry_type(geometry_types(polys))
+        pyogrio.raw.write(
+            self._container, shapely.to_wkb(polys),
+            field_data=[np.array(poly_judge_results[name], dtype=object) for name in POLY_FIELDS],
+            fields=POLY_FIELDS, layer=file[:-4], driver="GPKG", geometry_type=geometry_type,
+            promote_to_multi=promote_to_multi, crs=crs, encoding="UTF-8")
+
+    def _write_parquet(self, file, poly_judge_results, polys, crs):
+        import pyarrow as pa  # parquet形式の出力時のみ必要
+        import pyarrow.parquet as pq
+
+        # 予測shp毎に行グループとして追記
+        print("parquet出力:", file[:-4])
+        columns = {'file': pa.array([file] * len(polys), pa.string())}
+        for name in POLY_FIELDS:
+            columns[name] = pa.array(poly_judge_results[name], pa.string())
+        columns['geometry'] = pa.array(shapely.to_wkb(polys).tolist(), pa.binary())
+        table = pa.table(columns)
+        if self._parquet is None:
+            # geoメタデータは全ファイルのジオメトリタイプが揃うclose時にフッターへ書き込むため、
+            # フッターと食い違うArrowスキーマは保存しない（列は全て文字列・バイナリのため読み込み結果は同じ）
+            self._parquet = pq.ParquetWriter(self._container, table.schema, store_schema=False)
+        self._parquet.write_table(table)
+        self._parquet_types.update(geometry_types(polys))
+        self._parquet_crs.add(crs)
+
+    def close(self):
+        self._eval1.close()
+        self._eval2.close()
+        if self._parquet is not None:
+            self._parquet.add_key_value_metadata({"geo": _geoparquet_metadata(sorted(self._parquet_types), self._parquet_projjson())})
+            self._parquet.close()
+            self._parquet = None
+
+    def _parquet_projjson(self):
+        """
+        全予測shpで共通の座標系（PROJJSON）。座標系の無いファイルや異なるファイルがある場合はNone
+        """
+        if len(self._parquet_crs) != 1 or None in self._parquet_crs:
+            if len(self._parquet_crs) > 1:
+                print("予測shpの座標系が一致しないため、parquetの座標系は未定義とします:", sorted(map(str, self._parquet_crs)))
+            return None
+        return CRS.from_user_input(next(iter(self._parquet_crs))).to_json_dict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
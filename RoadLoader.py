@@ -0,0 +1,399 @@
+# -*- coding: utf-8 -*-
+"""
+道路ポリゴンのシェープファイル読み込み（QuantEvaluate / QualEvaluate 共通）
+
+シェープファイル全体を列単位で読み込み、以下の列指向形式のdictで返す
+    "id": 道路ID（object配列）
+    "class": クラスコード（int8配列。CLASSESの添字、評価対象外は-1）
+    "poly": ポリゴン（shapelyのgeometry配列）
+"""
+import os
+import mmap
+import hashlib
+import pickle
+import tempfile
+import numpy as np
+import pyogrio
+import shapely
+from pyproj import Transformer
+
+
+# 正解データキャッシュ・レコード索引の形式バージョン（形式を変更した場合は更新する）
+TRUE_CACHE_VERSION = 1
+RECORD_INDEX_VERSION = 1
+# レコード索引（サイドカーファイル）の拡張子
+RECORD_INDEX_EXT = ".ridx"
+
+# 評価対象クラス（confusion matrixの行・列の並び）
+CLASSES = ['1000', '1020', '2000', '3000']
+CLASS_INDEX = {cls: i for i, cls in enumerate(CLASSES)}
+
+
+def convert_class(set_class, set_intersec):
+    """
+    予測シェープファイルから正解シェープファイルのclass形式に変換（配列版）
+    """
+    set_class = np.asarray(set_class)
+    set_intersec = np.asarray(set_intersec)
+    return np.select(
+        [
+            (set_class == 1) & (set_intersec == 1),  # 車道交差部
+            set_class == 1,                          # 車道部
+            set_class == 2,                          # 歩道部
+            set_class == 3,                          # 島部
+        ],
+        [1020, 1000, 2000, 3000],
+        default=set_class)
+
+
+def class_codes(classes):
+    """
+    class値（文字列または数値）の配列をクラスコードに変換
+    """
+    classes = np.asarray(classes).astype(str)
+    codes = np.full(len(classes), -1, dtype=np.int8)
+    for code, cls in enumerate(CLASSES):
+        codes[classes == cls] = code
+    return codes
+
+
+def reproject(polys, crs, epsg):
+    """
+    ジオメトリ配列の座標系をcrsからEPSGコードの座標系へ変換
+    """
+    transformer = Transformer.from_crs(crs, f"EPSG:{epsg}", always_xy=True)
+    return shapely.transform(polys, lambda coords: np.column_stack(transformer.transform(coords[:, 0], coords[:, 1])))
+
+
+def _read_columns(shp_path, columns, encoding):
+    """
+    シェープファイルのジオメトリ(WKB)と指定列を一括で読み込む
+    """
+    meta, _, geometry, field_data = pyogrio.raw.read(shp_path, columns=columns, encoding=encoding)
+    fields = dict(zip(meta["fields"], field_data))
+    return meta["crs"], shapely.from_wkb(geometry), fields
+
+
+def read_road_pred_columns(shp_path, encoding="Shift-JIS"):
+    """
+    予測シェープファイル読み込み機能（列指向形式）
+    """
+    _, polys, fields = _read_columns(shp_path, ["lod1_id", "class", "is_in_inte"], encoding)
+    cls = convert_class(fields["class"], fields["is_in_inte"])
+    return {"id": fields["lod1_id"], "class": class_codes(cls), "poly": polys}
+
+
+def read_road_true_columns(shp_path, id_field="id", epsg=None, encoding="Shift-JIS", cache_dir=None):
+    """
+    正解シェープファイル読み込み機能（列指向形式）
+    評価対象の4クラスかつジオメトリを持つレコードのみ返す
+    Arguments:
+        id_field: 道路IDの列名（仙台・三鷹は"gml_id"）
+        epsg: 変換先のEPSGコード。Noneの場合は変換しない（変換元は.prjの座標系）
+        cache_dir: 読み込み結果のキャッシュフォルダ。Noneの場合はキャッシュしない
+    """
+    if cache_dir is not None:
+        return _read_road_true_cached(shp_path, cache_dir, id_field, epsg, encoding)
+    return _read_road_true(shp_path, id_field, epsg, encoding)
+
+
+def _read_road_true(shp_path, id_field, epsg, encoding):
+    """
+    正解シェープファイルの読み込み・クラス絞り込み・座標変換
+    """
+    crs, polys, fields = _read_columns(shp_path, [id_field, "class"], encoding)
+    codes = class_codes(fields["class"])
+
+    null = shapely.is_missing(polys) | shapely.is_empty(polys)
+    if np.any(null & (codes >= 0)):
+        print("NULL shape found:", int(np.sum(null & (codes >= 0))), shp_path)
+
+    keep = (codes >= 0) & ~null
+    polys = polys[keep]
+    if epsg:
+        polys = reproject(polys, crs, epsg)
+    return {"id": fields[id_field][keep], "class": codes[keep], "poly": polys}
+
+
+def _file_stats(shp_path):
+    """
+    シェープファイル構成ファイルのサイズ・更新時刻（キャッシュの無効化判定用）
+    """
+    stats = []
+    for ext in [".shp", ".shx", ".dbf", ".prj", ".cpg"]:
+        path = shp_path[:-4] + ext
+        if os.path.exists(path):
+            stat = os.stat(path)
+            stats.append((ext, stat.st_size, stat.st_mtime_ns))
+    return tuple(stats)
+
+
+def _true_cache_key(shp_path, id_field, epsg, encoding):
+    """
+    正解データキャッシュのキー（構成ファイルのサイズ・更新時刻と読み込み条件）
+    """
+    return (TRUE_CACHE_VERSION, os.path.abspath(shp_path), _file_stats(shp_path), id_field, epsg, encoding)
+
+
+def _write_pickle(path, obj):
+    """
+    他プロセスと競合しないよう一時ファイルに書き込んでから置き換える
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def _read_road_true_cached(shp_path, cache_dir, id_field, epsg, encoding):
+    """
+    正解シェープファイルの読み込み（ディスクキャッシュ付き）
+    クラス絞り込み・座標変換済みのデータと妥当性判定結果("valid"列)をcache_dirに保存し、
+    シェープファイルの更新・読み込み条件の変更時は自動で作り直す
+    """
+    key = _true_cache_key(shp_path, id_field, epsg, encoding)
+    # ファイル名は読み込み条件のみで決め、ファイル更新時は同じキャッシュを上書きする
+    name = repr((key[0], key[1], id_field, epsg, encoding))
+    cache_path = os.path.join(cache_dir, hashlib.sha1(name.encode("utf-8")).hexdigest() + ".pkl")
+
+    if os.path.exists(cache_path):
+        try:
+            with open(cache_path, "rb") as f:
+                cache = pickle.load(f)
+            if cache["key"] == key:
+                columns = cache["columns"]
+                columns["poly"] = shapely.from_wkb(columns["poly"])
+                return columns
+        except Exception as e:
+            print("正解データキャッシュの読み込みに失敗:", cache_path, e)
+
+    columns = _read_road_true(shp_path, id_field, epsg, encoding)
+    columns["valid"] = shapely.is_valid(columns["poly"])
+
+    os.makedirs(cache_dir, exist_ok=True)
+    _write_pickle(cache_path, {"key": key, "columns": dict(columns, poly=shapely.to_wkb(columns["poly"]))})
+
+    return columns
+
+
+def _read_shx_offsets(shp_path):
+    """
+    .shxから各レコードの.shp内オフセット(byte)を読み込む
+    """
+    with open((shp_path[:-4] + ".shx").encode("utf-8"), "rb") as f:
+        shx = np.frombuffer(f.read(), dtype=">i4", offset=100).reshape(-1, 2)
+    return shx[:, 0].astype(np.int64) * 2
+
+
+def _read_record_bboxes(shp_path, offsets):
+    """
+    .shpをメモリマップし、各レコードのshapeTypeとbboxのみを読み込む（NULLシェイプのbboxはNaN）
+    """
+    with open(shp_path.encode("utf-8"), "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        buf = np.frombuffer(mm, dtype=np.uint8)
+        last = len(buf) - 1
+        shape_types = buf[np.minimum((offsets + 8)[:, None] + np.arange(4), last)].copy().view("<i4").ravel()
+        bboxes = buf[np.minimum((offsets + 12)[:, None] + np.arange(32), last)].copy().view("<f8").reshape(-1, 4)
+        del buf
+    bboxes[shape_types == 0] = np.nan
+    return bboxes
+
+
+def build_record_index(shp_path, id_field="id", encoding="Shift-JIS"):
+    """
+    道路ID→レコード番号の索引と、レコード毎のクラスコード・bboxを作成する
+    ジオメトリはデコードせず、属性(dbf)と.shx・.shpのレコードヘッダのみ読み込む
+    """
+    meta, _, _, field_data = pyogrio.raw.read(shp_path, columns=[id_field, "class"], read_geometry=False, encoding=encoding)
+    fields = dict(zip(meta["fields"], field_data))
+    codes = class_codes(fields["class"])
+    offsets = _read_shx_offsets(shp_path)
+    bboxes = _read_record_bboxes(shp_path, offsets)
+
+    # 評価対象クラスかつNULLシェイプ以外のレコードを道路ID毎にまとめる
+    record_nums = np.flatnonzero((codes >= 0) & ~np.isnan(bboxes[:, 0]))
+    id_records = {}
+    for record_num, id in zip(record_nums.tolist(), fields[id_field][record_nums].tolist()):
+        id_records.setdefault(id, []).append(record_num)
+
+    return {
+        "key": (RECORD_INDEX_VERSION, _file_stats(shp_path), id_field, encoding),
+        "id_records": {id: np.array(nums, dtype=np.int64) for id, nums in id_records.items()},
+        "id": fields[id_field],
+        "class": codes,
+        "offset": offsets,
+        "bbox": bboxes,
+        "crs": meta["crs"],
+    }
+
+
+def load_record_index(shp_path, id_field="id", encoding="Shift-JIS"):
+    """
+    レコード索引の読み込み。シェープファイルと同じ場所のサイドカーファイル(.ridx)を使い、
+    無い場合・シェープファイルが更新された場合は作成し直す（書き込めない場所では保存しない）
+    """
+    index_path = shp_path[:-4] + RECORD_INDEX_EXT
+    key = (RECORD_INDEX_VERSION, _file_stats(shp_path), id_field, encoding)
+    if os.path.exists(index_path):
+        try:
+            with open(index_path, "rb") as f:
+                index = pickle.load(f)
+            if index["key"] == key:
+                return index
+        except Exception as e:
+            print("レコード索引の読み込みに失敗:", index_path, e)
+
+    index = build_record_index(shp_path, id_field, encoding)
+    try:
+        _write_pickle(index_path, index)
+    except OSError as e:
+        print("レコード索引を保存できません:", index_path, e)
+    return index
+
+
+def records_for_ids(index, ids):
+    """
+    道路IDのリストに対応するレコード番号（昇順）
+    """
+    nums = [index["id_records"][id] for id in ids if id in index["id_records"]]
+    if not nums:
+        return np.empty(0, dtype=np.int64)
+    return np.sort(np.concatenate(nums))
+
+
+def records_in_bbox(index, bbox):
+    """
+    bbox(xmin, ymin, xmax, ymax)と重なる評価対象レコードの番号（昇順）
+    レコードbboxのpacked R-tree(STRtree)は初回に作成する
+    """
+    if "tree" not in index:
+        record_nums = np.sort(np.concatenate(list(index["id_records"].values()) or [np.empty(0, dtype=np.int64)]))
+        index["tree"] = (record_nums, shapely.STRtree(shapely.box(*index["bbox"][record_nums].T)))
+    record_nums, tree = index["tree"]
+    return np.sort(record_nums[tree.query(shapely.box(*bbox))])
+
+
+def _is_cw(ring):
+    """
+    リングが時計回り（シェープファイルの外周）か
+    """
+    x = ring[:, 0]
+    y = ring[:, 1]
+    return np.dot(x[:-1], y[1:]) - np.dot(x[1:], y[:-1]) < 0
+
+
+def _decode_polygon(content):
+    """
+    Polygon(5/15/25)レコードの内容をshapelyのPolygon / MultiPolygonに変換
+    外周（時計回り）と穴（反時計回り）の対応付けはpyshpの__geo_interface__と同じ規則とする
+    """
+    num_parts, num_points = np.frombuffer(content, dtype="<i4", count=2, offset=36)
+    parts = np.frombuffer(content, dtype="<i4", count=num_parts, offset=44)
+    points = np.frombuffer(content, dtype="<f8", count=2 * num_points, offset=44 + 4 * num_parts).reshape(-1, 2)
+    rings = np.split(points, parts[1:])
+
+    exteriors = [ring for ring in rings if _is_cw(ring)]
+    holes = [ring for ring in rings if not _is_cw(ring)]
+    if not exteriors:
+        # 外周が無い場合は各リングを穴の無い外周とする
+        exteriors, holes = holes, []
+    if len(exteriors) == 1:
+        return shapely.Polygon(exteriors[0], holes)
+
+    # 穴は代表点を含む外周のうち最も面積の小さいものに割り当て、含む外周が無い穴は外周とする
+    shells = [shapely.Polygon(ring) for ring in exteriors]
+    shell_holes = [[] for _ in exteriors]
+    orphans = []
+    for hole in holes:
+        parents = [i for i, shell in enumerate(shells) if shell.contains(shapely.Point(hole[0]))]
+        if parents:
+            shell_holes[min(parents, key=lambda i: shells[i].area)].append(hole)
+        else:
+            orphans.append(hole)
+    polys = [shapely.Polygon(ring, ring_holes) for ring, ring_holes in zip(exteriors, shell_holes)]
+    polys += [shapely.Polygon(ring) for ring in orphans]
+    return shapely.MultiPolygon(polys)
+
+
+def read_road_true_records(shp_path, record_nums, index, epsg=None):
+    """
+    正解シェープファイルの指定レコードのみを読み込む（列指向形式）
+    .shpをメモリマップし、索引のオフセットを使って必要なレコードのみデコードする
+    Arguments:
+        record_nums: 読み込むレコード番号（records_for_ids / records_in_bboxの結果）
+        index: load_record_indexで読み込んだレコード索引
+        epsg: 変換先のEPSGコード。Noneの場合は変換しない（変換元は.prjの座標系）
+    """
+    record_nums = np.asarray(record_nums, dtype=np.int64)
+    polys = np.empty(len(record_nums), dtype=object)
+    with open(shp_path.encode("utf-8"), "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        for i, record_num in enumerate(record_nums.tolist()):
+            offset = int(index["offset"][record_num])
+            length = int.from_bytes(mm[offset + 4:offset + 8], "big") * 2
+            polys[i] = _decode_polygon(mm[offset + 8:offset + 8 + length])
+
+    if epsg and len(polys):
+        polys = reproject(polys, index["crs"], epsg)
+
+    return {"id": index["id"][record_nums], "class": index["class"][record_nums], "poly": polys}
+
+
+def is_valid_columns(columns):
+    """
+    列指向形式のジオメトリの妥当性（キャッシュ済みの場合は再判定しない）
+    """
+    if "valid" in columns:
+        return columns["valid"]
+    return shapely.is_valid(columns["poly"])
+
+
+def concat_columns(columns_list):
+    """
+    列指向形式のデータを連結
+    """
+    if not columns_list:
+        return {"id": np.empty(0, dtype=object), "class": np.empty(0, dtype=np.int8), "poly": np.empty(0, dtype=object)}
+    return {key: np.concatenate([columns[key] for columns in columns_list]) for key in columns_list[0]}
+
+
+def columns_to_records(columns):
+    """
+    列指向形式を[{"id":string, "class":string, "poly":polygon}]形式に変換（評価対象外のclassはNone）
+    """
+    classes = [CLASSES[code] if code >= 0 else None for code in columns["class"].tolist()]
+    return [
+        {"id": id, "class": cls, "poly": poly}
+        for id, cls, poly in zip(columns["id"].tolist(), classes, columns["poly"].tolist())
+    ]
+
+
+def group_by_id(data):
+    """
+    ポリゴンリストを道路ID毎に振り分ける（出現順を保持）
+    Returns:
+        dict: {id: [{"id":string, "class":string, "poly":polygon}]}
+    """
+    groups = {}
+    for elem in data:
+        groups.setdefault(elem.get('id'), []).append(elem)
+    return groups
+
+
+def true_id_field(city):
+    """
+    正解シェープファイルの道路IDの列名
+    """
+    if city == "sendai" or city == "mitaka":
+        return "gml_id"
+    return "id"
+
+
+def read_crs(shp_path):
+    """
+    シェープファイルの座標系（"EPSG:6677"またはWKT、.prjが無い場合はNone）
+    """
+    return pyogrio.read_info(shp_path)["crs"]
@@ -1 +1 @@
-from .polyskel import skeletonize, set_debug, log
+from .polyskel import skeletonize, set_debug, set_production, set_stats, Stats, SkeletonBudgetExceeded, log
@@ -0,0 +1,41 @@
+import argparse
+import math
+import random
+import time
+import polyskel
+
+
+def jagged_strip(n_vertices, seed=0):
+	"""
+	A long, narrow polygon with jagged sides, like the difference of two road polygons.
+	The vertices are in clockwise order (counter-clockwise with the y-axis going downwards).
+	"""
+	rng = random.Random(seed)
+	n_side = max(2, n_vertices // 2)
+	bottom = [(i * 2.0, rng.uniform(-0.8, 0.8)) for i in range(n_side)]
+	top = [(i * 2.0 + rng.uniform(-0.5, 0.5), 6.0 + rng.uniform(-0.8, 0.8)) for i in reversed(range(n_side))]
+	return list(reversed(top + bottom))
+
+
+def run(polygon, min_edges):
+	polyskel.SPLIT_INDEX_MIN_EDGES = min_edges
+	start = time.perf_counter()
+	skeleton = polyskel.skeletonize(polygon, holes=[])
+	elapsed = time.perf_counter() - start
+	return elapsed, [(tuple(arc.source), arc.height, [tuple(sink) for sink in arc.sinks]) for arc in skeleton]
+
+
+if __name__ == "__main__":
+	argparser = argparse.ArgumentParser(description="Compare the split event search with and without the spatial index on jagged polygons.")
+	argparser.add_argument('--sizes', type=int, nargs='+', default=[100, 300, 1000, 2000, 5000], help="numbers of polygon vertices")
+	argparser.add_argument('--seed', type=int, default=0)
+	args = argparser.parse_args()
+
+	default_min_edges = polyskel.SPLIT_INDEX_MIN_EDGES
+	print("{:>8} {:>12} {:>12} {:>8} {:>10}".format("vertices", "full scan(s)", "index(s)", "speedup", "identical"))
+	for size in args.sizes:
+		polygon = jagged_strip(size, args.seed)
+		full_time, full_skeleton = run(polygon, math.inf)
+		index_time, index_skeleton = run(polygon, default_min_edges)
+		print("{:>8} {:>12.3f} {:>12.3f} {:>8.1f} {:>10}".format(len(polygon), full_time, index_time, full_time / index_time, str(full_skeleton == index_skeleton)))
+	polyskel.SPLIT_INDEX_MIN_EDGES = default_min_edges
@@ -6,7 +6,9 @@ Implementation of the straight skeleton algorithm as described by Felkel and Obd
 
 import logging
 import heapq
-from euclid3 import *
+import math
+import time
+from euclid3 import Point2
 from itertools import *
 from collections import namedtuple
 
@@ -14,6 +16,9 @@ log = logging.getLogger("__name__")
 
 EPSILON = 0.00001
 
+# polygons with at least this many edges look up split event candidates in a spatial index
+SPLIT_INDEX_MIN_EDGES = 32
+
 class Debug:
 	def __init__(self, image):
 		if image is not None:
@@ -44,6 +49,71 @@ def set_debug(image):
 	_debug = Debug(image)
 
 
+_production = False
+# whether the current skeletonize call logs and draws; set at the start of each call
+_trace = False
+_draw = False
+
+
+def set_production(enabled=True):
+	"""
+	In production mode skeletonize does no logging and no debug drawing, whatever the log level
+	and set_debug say. Without it, logging is still skipped for calls made while INFO is disabled.
+	"""
+	global _production
+	_production = enabled
+
+
+class SkeletonBudgetExceeded(RuntimeError):
+	"""
+	Raised by skeletonize when a call takes more events or seconds than its budget allows,
+	or when walking a broken vertex chain would otherwise never end.
+	"""
+
+
+class Stats:
+	"""
+	Counters of the skeletonize calls made while registered with set_stats.
+	timings holds (number of vertices, seconds) for each completed call; calls that ran out of
+	budget are only counted in budget_exceeded.
+	"""
+	COUNTERS = ("calls", "edge_events", "split_events", "peak_events", "discarded_events", "failed_splits", "budget_exceeded")
+
+	def __init__(self):
+		for name in self.COUNTERS:
+			setattr(self, name, 0)
+		self.max_queue = 0
+		self.timings = []
+
+	@property
+	def seconds(self):
+		return sum(seconds for _, seconds in self.timings)
+
+	def merge(self, other):
+		"""Add the counts of another Stats, e.g. one collected in a worker process."""
+		for name in self.COUNTERS:
+			setattr(self, name, getattr(self, name) + getattr(other, name))
+		self.max_queue = max(self.max_queue, other.max_queue)
+		self.timings.extend(other.timings)
+
+	def __str__(self):
+		lines = ["{} calls in {:.3f}s".format(self.calls, self.seconds)]
+		lines.extend("{}: {}".format(name, getattr(self, name)) for name in self.COUNTERS[1:])
+		lines.append("max_queue: {}".format(self.max_queue))
+		slowest = sorted(self.timings, key=lambda timing: timing[1], reverse=True)[:5]
+		lines.append("slowest: " + ", ".join("{} vertices {:.3f}s".format(*timing) for timing in slowest))
+		return "\n".join(lines)
+
+
+_stats = None
+
+
+def set_stats(stats):
+	"""Collect the counters of subsequent skeletonize calls into stats (a Stats), or stop with None."""
+	global _stats
+	_stats = stats
+
+
 def _window(lst):
 	prevs, items, nexts = tee(lst, 3)
 	prevs = islice(cycle(prevs), len(lst) - 1, None)
@@ -51,22 +121,113 @@ def _window(lst):
 	return zip(prevs, items, nexts)
 
 
+# Points and vectors are plain (x, y) float tuples. The helpers below reproduce the
+# arithmetic of the euclid3 operations they replace operation by operation, so the
+# skeleton is bit-for-bit the same as the one computed with euclid3 objects.
+
 def _cross(a, b):
-	res = a.x * b.y - b.x * a.y
+	res = a[0] * b[1] - b[0] * a[1]
 	return res
 
 
+def _normalized(x, y):
+	d = math.sqrt(x ** 2 + y ** 2)
+	if d:
+		return (x / d, y / d)
+	return (x, y)
+
+
+def _distance(a, b):
+	return math.sqrt((b[0] - a[0]) ** 2 + (b[1] - a[1]) ** 2)
+
+
+def _intersect(a, b):
+	"""
+	Intersection of the lines (or rays) a and b, as euclid3's a.intersect(b) would compute it.
+	The resulting point lies on b.
+	"""
+	(ax, ay), (avx, avy) = a.p, a.v
+	(bx, by), (bvx, bvy) = b.p, b.v
+	d = avy * bvx - avx * bvy
+	if d == 0:
+		return None
+
+	dy = by - ay
+	dx = bx - ax
+	ub = (avx * dy - avy * dx) / d
+	if b.is_ray and not ub >= 0.0:
+		return None
+	if a.is_ray:
+		ua = (bvx * dy - bvy * dx) / d
+		if not ua >= 0.0:
+			return None
+
+	return (bx + ub * bvx, by + ub * bvy)
+
+
 def _approximately_equals(a, b):
 	return a == b or (abs(a - b) <= max(abs(a), abs(b)) * 0.001)
 
 
+def _approximately_equals_point(a, b):
+	if a[0] == b[0] and a[1] == b[1]:
+		return True
+	return math.sqrt((a[0] - b[0]) ** 2 + (a[1] - b[1]) ** 2) <= max(math.sqrt(a[0] ** 2 + a[1] ** 2), math.sqrt(b[0] ** 2 + b[1] ** 2)) * 0.001
+
+
 def _approximately_same(point_a, point_b):
-	return _approximately_equals(point_a.x, point_b.x) and _approximately_equals(point_a.y, point_b.y)
+	return _approximately_equals(point_a[0], point_b[0]) and _approximately_equals(point_a[1], point_b[1])
 
 
 def _normalize_contour(contour):
-	contour = [Point2(float(x), float(y)) for (x, y) in contour]
-	return [point for prev, point, next in _window(contour) if not (point == next or (point-prev).normalized() == (next - point).normalized())]
+	contour = [(float(x), float(y)) for (x, y) in contour]
+	return [point for prev, point, next in _window(contour) if not (
+		(point[0] == next[0] and point[1] == next[1]) or
+		_normalized(point[0] - prev[0], point[1] - prev[1]) == _normalized(next[0] - point[0], next[1] - point[1]))]
+
+
+class _Line:
+	"""
+	A line through p with direction v. The normalized direction and the squared length of v
+	are computed once, since the event computations ask for them over and over.
+	"""
+	__slots__ = ("p", "v", "direction", "length_squared")
+	is_ray = False
+
+	def __init__(self, p, v):
+		self.p = p
+		self.v = v
+		self.direction = _normalized(*v)
+		self.length_squared = v[0] ** 2 + v[1] ** 2
+
+	def distance(self, point):
+		"""
+		Distance of point from the (infinite) line.
+		"""
+		(px, py), (vx, vy) = self.p, self.v
+		u = ((point[0] - px) * vx + (point[1] - py) * vy) / self.length_squared
+		return math.sqrt((px + u * vx - point[0]) ** 2 + (py + u * vy - point[1]) ** 2)
+
+	def __repr__(self):
+		return 'Line2(<%.2f, %.2f> + u<%.2f, %.2f>)' % (self.p[0], self.p[1], self.v[0], self.v[1])
+
+
+class _Ray(_Line):
+	__slots__ = ()
+	is_ray = True
+
+	def __repr__(self):
+		return 'Ray2(<%.2f, %.2f> + u<%.2f, %.2f>)' % (self.p[0], self.p[1], self.v[0], self.v[1])
+
+
+class _Segment(_Line):
+	__slots__ = ()
+
+	def __init__(self, a, b):
+		_Line.__init__(self, a, (b[0] - a[0], b[1] - a[1]))
+
+	def __repr__(self):
+		return 'LineSegment2(<%.2f, %.2f> to <%.2f, %.2f>)' % (self.p[0], self.p[1], self.p[0] + self.v[0], self.p[1] + self.v[1])
 
 
 class _SplitEvent(namedtuple("_SplitEvent", "distance, intersection_point, vertex, opposite_edge")):
@@ -95,6 +256,8 @@ Subtree = namedtuple("Subtree", "source, height, sinks")
 
 
 class _LAVertex:
+	__slots__ = ("point", "edge_left", "edge_right", "prev", "next", "lav", "_valid", "_is_reflex", "_bisector")
+
 	def __init__(self, point, edge_left, edge_right, direction_vectors=None):
 		self.point = point
 		self.edge_left = edge_left
@@ -104,14 +267,19 @@ class _LAVertex:
 		self.lav = None
 		self._valid = True  # TODO this might be handled better. Maybe membership in lav implies validity?
 
-		creator_vectors = (edge_left.v.normalized() * -1, edge_right.v.normalized())
+		left = edge_left.direction
+		right = edge_right.direction
+		creator_vectors = ((-left[0], -left[1]), right)
 		if direction_vectors is None:
 			direction_vectors = creator_vectors
 
 		self._is_reflex = (_cross(*direction_vectors)) < 0
-		self._bisector = Ray2(self.point, operator.add(*creator_vectors) * (-1 if self.is_reflex else 1))
-		log.info("Created vertex %s", self.__repr__())
-		_debug.line((self.bisector.p.x, self.bisector.p.y, self.bisector.p.x + self.bisector.v.x * 100, self.bisector.p.y + self.bisector.v.y * 100), fill="blue")
+		sign = -1 if self._is_reflex else 1
+		self._bisector = _Ray(self.point, ((creator_vectors[0][0] + right[0]) * sign, (creator_vectors[0][1] + right[1]) * sign))
+		if _trace:
+			log.info("Created vertex %r", self)
+		if _draw:
+			_debug.line((self.bisector.p[0], self.bisector.p[1], self.bisector.p[0] + self.bisector.v[0] * 100, self.bisector.p[1] + self.bisector.v[1] * 100), fill="blue")
 
 	@property
 	def bisector(self):
@@ -127,71 +295,114 @@ class _LAVertex:
 
 	def next_event(self):
 		events = []
+		point = self.point
+		i_prev = _intersect(self.bisector, self.prev.bisector)
+		i_next = _intersect(self.bisector, self.next.bisector)
+
 		if self.is_reflex:
 			# a reflex vertex may generate a split event
 			# split events happen when a vertex hits an opposite edge, splitting the polygon in two.
-			log.debug("looking for split candidates for vertex %s", self)
-			for edge in self.original_edges:
-				if edge.edge == self.edge_left or edge.edge == self.edge_right:
-					continue
-
-				log.debug("\tconsidering EDGE %s", edge)
-
-				# a potential b is at the intersection of between our own bisector and the bisector of the
-				# angle between the tested edge and any one of our own edges.
-
-				# we choose the "less parallel" edge (in order to exclude a potentially parallel edge)
-				leftdot = abs(self.edge_left.v.normalized().dot(edge.edge.v.normalized()))
-				rightdot = abs(self.edge_right.v.normalized().dot(edge.edge.v.normalized()))
-				selfedge = self.edge_left if leftdot < rightdot else self.edge_right
-				otheredge = self.edge_left if leftdot > rightdot else self.edge_right
-
-				i = Line2(selfedge).intersect(Line2(edge.edge))
-				if i is not None and not _approximately_equals(i, self.point):
-					# locate candidate b
-					linvec = (self.point - i).normalized()
-					edvec = edge.edge.v.normalized()
-					if linvec.dot(edvec) < 0:
-						edvec = -edvec
-
-					bisecvec = edvec + linvec
-					if abs(bisecvec) == 0:
-						continue
-					bisector = Line2(i, bisecvec)
-					b = bisector.intersect(self.bisector)
-
-					if b is None:
-						continue
-
-					# check eligibility of b
-					# a valid b should lie within the area limited by the edge and the bisectors of its two vertices:
-					xleft	= _cross(edge.bisector_left.v.normalized(), (b - edge.bisector_left.p).normalized()) > -EPSILON
-					xright	= _cross(edge.bisector_right.v.normalized(), (b - edge.bisector_right.p).normalized()) < EPSILON
-					xedge	= _cross(edge.edge.v.normalized(), (b - edge.edge.p).normalized()) < EPSILON
-
-					if not (xleft and xright and xedge):
-						log.debug("\t\tDiscarded candidate %s (%s-%s-%s)", b, xleft, xright, xedge)
-						continue
-
-					log.debug("\t\tFound valid candidate %s", b)
-					events.append(_SplitEvent(Line2(edge.edge).distance(b), b, self, edge.edge))
-
-		i_prev = self.bisector.intersect(self.prev.bisector)
-		i_next = self.bisector.intersect(self.next.bisector)
+			if _trace:
+				log.debug("looking for split candidates for vertex %s", self)
+			events = self._find_split_events(i_prev, i_next)
 
 		if i_prev is not None:
-			events.append(_EdgeEvent(Line2(self.edge_left).distance(i_prev), i_prev, self.prev, self))
+			events.append(_EdgeEvent(self.edge_left.distance(i_prev), i_prev, self.prev, self))
 		if i_next is not None:
-			events.append(_EdgeEvent(Line2(self.edge_right).distance(i_next), i_next, self, self.next))
+			events.append(_EdgeEvent(self.edge_right.distance(i_next), i_next, self, self.next))
 
 		if not events:
 			return None
 
-		ev = min(events, key=lambda event: self.point.distance(event.intersection_point))
+		ev = min(events, key=lambda event: _distance(point, event.intersection_point))
 
-		log.info("Generated new event for %s: %s", self, ev)
+		if _trace:
+			log.info("Generated new event for %s: %s", self, ev)
 		return ev
 
+	def _split_event(self, edge):
+		"""
+		The split event of this (reflex) vertex against an original edge, if any
+		"""
+		if edge.edge is self.edge_left or edge.edge is self.edge_right:
+			return None
+
+		point = self.point
+		left = self.edge_left.direction
+		right = self.edge_right.direction
+		if _trace:
+			log.debug("\tconsidering EDGE %s", edge)
+
+		# a potential b is at the intersection of between our own bisector and the bisector of the
+		# angle between the tested edge and any one of our own edges.
+
+		# we choose the "less parallel" edge (in order to exclude a potentially parallel edge)
+		edvec = edge.edge.direction
+		leftdot = abs(left[0] * edvec[0] + left[1] * edvec[1])
+		rightdot = abs(right[0] * edvec[0] + right[1] * edvec[1])
+		selfedge = self.edge_left if leftdot < rightdot else self.edge_right
+
+		i = _intersect(selfedge, edge.edge)
+		if i is not None and not _approximately_equals_point(i, point):
+			# locate candidate b
+			linvec = _normalized(point[0] - i[0], point[1] - i[1])
+			if linvec[0] * edvec[0] + linvec[1] * edvec[1] < 0:
+				edvec = (-edvec[0], -edvec[1])
+
+			bisecvec = (edvec[0] + linvec[0], edvec[1] + linvec[1])
+			if bisecvec[0] ** 2 + bisecvec[1] ** 2 == 0:
+				return None
+			b = _intersect(_Line(i, bisecvec), self.bisector)
+
+			if b is None:
+				return None
+
+			# check eligibility of b
+			# a valid b should lie within the area limited by the edge and the bisectors of its two vertices:
+			xleft	= _cross(edge.bisector_left.direction, _normalized(b[0] - edge.bisector_left.p[0], b[1] - edge.bisector_left.p[1])) > -EPSILON
+			xright	= _cross(edge.bisector_right.direction, _normalized(b[0] - edge.bisector_right.p[0], b[1] - edge.bisector_right.p[1])) < EPSILON
+			xedge	= _cross(edge.edge.direction, _normalized(b[0] - edge.edge.p[0], b[1] - edge.edge.p[1])) < EPSILON
+
+			if not (xleft and xright and xedge):
+				if _trace:
+					log.debug("\t\tDiscarded candidate %s (%s-%s-%s)", b, xleft, xright, xedge)
+				return None
+
+			if _trace:
+				log.debug("\t\tFound valid candidate %s", b)
+			return _SplitEvent(edge.edge.distance(b), b, self, edge.edge)
+		return None
+
+	def _find_split_events(self, i_prev, i_next):
+		"""
+		The split events of this vertex that next_event may choose, in the order of the original edges.
+		The event closest to the vertex wins, so only the edges whose split points can lie within the
+		nearest event found so far have to be tested. Without an index all edges are tested.
+		"""
+		edges = self.original_edges
+		index = self.lav._slav._split_index
+		if index is None:
+			return [event for event in map(self._split_event, edges) if event is not None]
+
+		reach = [_distance(self.point, i) for i in (i_prev, i_next) if i is not None]
+		bound = min(reach) if reach else math.inf
+		radius = min(bound, math.sqrt(max(self.edge_left.length_squared, self.edge_right.length_squared)))
+		tested = {}
+		while True:
+			numbers = index.candidates(self.bisector, radius)
+			if numbers is None:
+				return [event for event in map(self._split_event, edges) if event is not None]
+			for n in numbers:
+				if n not in tested:
+					tested[n] = self._split_event(edges[n])
+			events = [tested[n] for n in sorted(tested) if tested[n] is not None]
+			if radius >= bound:
+				return events
+			if events and min(_distance(self.point, event.intersection_point) for event in events) <= radius:
+				return events
+			# search farther; past the reach of the tree the whole bisector is covered at once
+			radius = min(bound, radius * 4) if 0 < radius < index.reach else bound
+
 	def invalidate(self):
 		if self.lav is not None:
 			self.lav.invalidate(self)
@@ -203,31 +414,266 @@ class _LAVertex:
 		return self._valid
 
 	def __str__(self):
-		return "Vertex ({:.2f};{:.2f})".format(self.point.x, self.point.y)
+		return "Vertex ({:.2f};{:.2f})".format(self.point[0], self.point[1])
 
 	def __repr__(self):
 		return "Vertex ({}) ({:.2f};{:.2f}), bisector {}, edges {} {}".format("reflex" if self.is_reflex else "convex",
-																			  self.point.x, self.point.y, self.bisector,
+																			  self.point[0], self.point[1], self.bisector,
 																			  self.edge_left, self.edge_right)
 
 
+class _SplitIndex:
+	"""
+	STR-packed R-tree over the regions in which the original edges can produce split events.
+
+	A split point b of an edge passes the eligibility tests of next_event: it lies left of the edge's
+	left bisector, right of its right bisector and inside the edge, each up to EPSILON times its
+	distance from the edge's endpoint. Inside a box around the polygon that distance is at most the
+	box diagonal, so there each region is contained in the intersection of three half-planes shifted
+	by a fixed slack; the tree indexes these regions clipped to the box. Bisectors leaving the box are
+	tested against each edge instead, with the slack growing along the bisector.
+	"""
+	NODE_CAPACITY = 16
+
+	def __init__(self, original_edges):
+		self._edges = original_edges
+		xs = [edge.edge.p[0] for edge in original_edges]
+		ys = [edge.edge.p[1] for edge in original_edges]
+		self._bounds = (min(xs), min(ys), max(xs), max(ys))
+		margin = max(max(xs) - min(xs), max(ys) - min(ys)) * 0.5 + 1.0
+		self._box = (min(xs) - margin, min(ys) - margin, max(xs) + margin, max(ys) + margin)
+		# from within the polygon's bounds, distances up to this can be looked up in the tree
+		self.reach = margin / 2
+		self._slack = math.hypot(self._box[2] - self._box[0], self._box[3] - self._box[1]) * EPSILON * 2
+		box = self._box
+		ring = [(box[0], box[1]), (box[2], box[1]), (box[2], box[3]), (box[0], box[3])]
+
+		# (point, direction, side) of the eligibility tests: side * cross(direction, b - point) <= 0
+		self._tests = [((edge.bisector_left.p, edge.bisector_left.direction, -1),
+						(edge.bisector_right.p, edge.bisector_right.direction, 1),
+						(edge.edge.p, edge.edge.direction, 1)) for edge in original_edges]
+		self._half_planes = []
+		entries = []
+		for n, tests in enumerate(self._tests):
+			half_planes = tuple(self._half_plane(point, direction, side, self._slack) for point, direction, side in tests)
+			self._half_planes.append(half_planes)
+			region = ring
+			for half_plane in half_planes:
+				region = self._clip(region, half_plane)
+			if region:
+				region_xs = [q[0] for q in region]
+				region_ys = [q[1] for q in region]
+				entries.append((min(region_xs) - self._slack, min(region_ys) - self._slack,
+								max(region_xs) + self._slack, max(region_ys) + self._slack, n, None))
+
+		while len(entries) > self.NODE_CAPACITY:
+			entries = self._pack(entries)
+		self._root = entries
+
+	@staticmethod
+	def _half_plane(point, direction, side, offset):
+		"""
+		(a, b, c) with a*x + b*y + c <= 0 where side * cross(direction, q - point) <= offset
+		"""
+		(px, py), (dx, dy) = point, direction
+		# cross(direction, q - point) = -dy * x + dx * y + (dy * px - dx * py)
+		return (-dy * side, dx * side, (dy * px - dx * py) * side - offset)
+
+	@staticmethod
+	def _clip(ring, half_plane):
+		a, b, c = half_plane
+		clipped = []
+		for n, q in enumerate(ring):
+			r = ring[n - 1]
+			q_value = a * q[0] + b * q[1] + c
+			r_value = a * r[0] + b * r[1] + c
+			if (q_value <= 0) != (r_value <= 0):
+				t = r_value / (r_value - q_value)
+				clipped.append((r[0] + (q[0] - r[0]) * t, r[1] + (q[1] - r[1]) * t))
+			if q_value <= 0:
+				clipped.append(q)
+		return clipped
+
+	def _pack(self, entries):
+		capacity = self.NODE_CAPACITY
+		n_nodes = -(-len(entries) // capacity)
+		slice_size = -(-n_nodes // math.ceil(math.sqrt(n_nodes))) * capacity
+		entries = sorted(entries, key=lambda entry: entry[0] + entry[2])
+		nodes = []
+		for start in range(0, len(entries), slice_size):
+			slab = sorted(entries[start:start + slice_size], key=lambda entry: entry[1] + entry[3])
+			for k in range(0, len(slab), capacity):
+				children = slab[k:k + capacity]
+				nodes.append((min(child[0] for child in children), min(child[1] for child in children),
+							  max(child[2] for child in children), max(child[3] for child in children), None, children))
+		return nodes
+
+	def candidates(self, bisector, reach):
+		"""
+		The numbers of the original edges (ascending) whose split point on bisector may be at most
+		reach away from its origin, or None if all edges have to be tested
+		"""
+		(x0, y0), (vx, vy) = bisector.p, bisector.v
+		length = math.sqrt(vx ** 2 + vy ** 2)
+		if length == 0:
+			return None
+		dx, dy = vx / length, vy / length
+		reach = reach * (1 + 1e-9) + self._slack
+		x1, y1 = x0 + dx * reach, y0 + dy * reach
+
+		box = self._box
+		if not all(box[0] < x < box[2] and box[1] < y < box[3] for (x, y) in ((x0, y0), (x1, y1))):
+			return self._scan(x0, y0, dx, dy, reach)
+
+		minx, maxx = (x0, x1) if x0 < x1 else (x1, x0)
+		miny, maxy = (y0, y1) if y0 < y1 else (y1, y0)
+		found = []
+		stack = [self._root]
+		while stack:
+			for entry in stack.pop():
+				if entry[0] > maxx or entry[2] < minx or entry[1] > maxy or entry[3] < miny:
+					continue
+				if entry[5] is not None:
+					stack.append(entry[5])
+				elif self._reaches(entry[4], x0, y0, x1, y1):
+					found.append(entry[4])
+		found.sort()
+		return found
+
+	def _reaches(self, n, x0, y0, x1, y1):
+		"""
+		Whether the segment (x0, y0)-(x1, y1) meets the region of the n-th edge
+		"""
+		t_min, t_max = 0.0, 1.0
+		for a, b, c in self._half_planes[n]:
+			value0 = a * x0 + b * y0 + c
+			value1 = a * x1 + b * y1 + c
+			if value0 > 0 and value1 > 0:
+				return False
+			if value0 > 0:
+				t_min = max(t_min, value0 / (value0 - value1))
+			elif value1 > 0:
+				t_max = min(t_max, value0 / (value0 - value1))
+			if t_min > t_max:
+				return False
+		return True
+
+	def _scan(self, x0, y0, dx, dy, reach):
+		"""
+		The numbers of the edges whose region the bisector (x0, y0) + t * (dx, dy), 0 <= t <= reach may
+		meet. At t the split point is at most distance + t away from every edge endpoint, where distance
+		bounds how far the origin is from the polygon's vertices.
+		"""
+		bounds = self._bounds
+		distance = max(math.hypot(x - x0, y - y0) for x in (bounds[0], bounds[2]) for y in (bounds[1], bounds[3]))
+		epsilon = EPSILON * 2
+		margin = distance * epsilon + (abs(x0) + abs(y0)) * 1e-12
+		found = []
+		for n, tests in enumerate(self._tests):
+			t_min, t_max = 0.0, reach
+			for (px, py), (ex, ey), side in tests:
+				# side * cross(e, b - p) <= epsilon * (distance + t), as value + slope * t <= 0
+				value = side * (ex * (y0 - py) - ey * (x0 - px)) - margin
+				slope = side * (ex * dy - ey * dx) - epsilon
+				if slope > 0:
+					if value > -slope * t_min:
+						break
+					if value > -slope * t_max:
+						t_max = -value / slope
+				elif slope < 0:
+					if value > -slope * t_max:
+						break
+					if value > -slope * t_min:
+						t_min = -value / slope
+				elif value > 0:
+					break
+			else:
+				found.append(n)
+		return found
+
+
 class _SLAV:
 	def __init__(self, polygon, holes):
 		contours = [_normalize_contour(polygon)]
 		contours.extend([_normalize_contour(hole) for hole in holes])
 
+		# live vertices by the (start, direction) of their left and right edges
+		self._holders = {}
+		# no chain can be longer than the number of vertices ever created
+		self._vertex_count = 0
 		self._lavs = [_LAV.from_polygon(contour, self) for contour in contours]
 
 		# store original polygon edges for calculating split events
 		self._original_edges = [
-			_OriginalEdge(LineSegment2(vertex.prev.point, vertex.point), vertex.prev.bisector, vertex.bisector)
+			_OriginalEdge(_Segment(vertex.prev.point, vertex.point), vertex.prev.bisector, vertex.bisector)
 			for vertex in chain.from_iterable(self._lavs)
 		]
+		self._split_index = _SplitIndex(self._original_edges) if len(self._original_edges) >= SPLIT_INDEX_MIN_EDGES else None
 
 	def __iter__(self):
 		for lav in self._lavs:
 			yield lav
 
+	def _register(self, vertex):
+		self._vertex_count += 1
+		for edge in (vertex.edge_left, vertex.edge_right):
+			self._holders.setdefault((edge.p, edge.direction), []).append(vertex)
+
+	def _unregister(self, vertex):
+		# degenerate LAVs can invalidate a vertex that has already left its holder list
+		for edge in (vertex.edge_left, vertex.edge_right):
+			holders = self._holders.get((edge.p, edge.direction))
+			if holders is not None and vertex in holders:
+				holders.remove(vertex)
+
+	def _position(self, vertex):
+		"""The place of a live vertex when iterating over all LAVs."""
+		lav = vertex.lav
+		steps = 0
+		cur = lav.head
+		limit = self._vertex_count
+		while cur is not vertex:
+			cur = cur.next
+			steps += 1
+			if steps > limit:
+				self._check_chain(steps)
+		return self._lavs.index(lav), steps
+
+	def _check_chain(self, steps):
+		"""Give up once a walk along a LAV has taken more steps than there are vertices."""
+		if steps > self._vertex_count:
+			if _stats is not None:
+				_stats.budget_exceeded += 1
+			raise SkeletonBudgetExceeded("skeletonize gave up on a broken vertex chain after {} steps over {} vertices".format(
+				steps, self._vertex_count))
+
+	def _find_edge_holder(self, edge, point):
+		"""
+		The vertices (x, y) around the part of edge that point lies in front of, where x holds edge as its
+		left edge and y as its right edge, or (None, None). When several parts qualify, the first one in
+		LAV order is taken.
+		"""
+		found = []
+		for v in self._holders.get((edge.p, edge.direction), ()):
+			if edge.direction == v.edge_left.direction and edge.p == v.edge_left.p:
+				x = v
+				y = x.prev
+			else:
+				y = v
+				x = y.next
+			xleft	= _cross(y.bisector.direction, _normalized(point[0] - y.point[0], point[1] - y.point[1])) >= -EPSILON
+			xright	= _cross(x.bisector.direction, _normalized(point[0] - x.point[0], point[1] - x.point[1])) <= EPSILON
+			if _trace:
+				log.debug("Vertex %s holds edge as %s edge (%s, %s)", v, ("left" if x == v else "right"), xleft, xright)
+			if xleft and xright:
+				found.append((v, x, y))
+		if not found:
+			return None, None
+		# x and y usually both qualify, naming the same part of the edge
+		if any(item[1:] != found[0][1:] for item in found):
+			found.sort(key=lambda item: self._position(item[0]))
+		return found[0][1], found[0][2]
+
 	def __len__(self):
 		return len(self._lavs)
 
@@ -240,15 +686,17 @@ class _SLAV:
 
 		lav = event.vertex_a.lav
 		if event.vertex_a.prev == event.vertex_b.next:
-			log.info("%.2f Peak event at intersection %s from <%s,%s,%s> in %s", event.distance,
-					 event.intersection_point, event.vertex_a, event.vertex_b, event.vertex_a.prev, lav)
+			if _trace:
+				log.info("%.2f Peak event at intersection %s from <%s,%s,%s> in %s", event.distance,
+						 event.intersection_point, event.vertex_a, event.vertex_b, event.vertex_a.prev, lav)
 			self._lavs.remove(lav)
 			for vertex in list(lav):
 				sinks.append(vertex.point)
 				vertex.invalidate()
 		else:
-			log.info("%.2f Edge event at intersection %s from <%s,%s> in %s", event.distance, event.intersection_point,
-					 event.vertex_a, event.vertex_b, lav)
+			if _trace:
+				log.info("%.2f Edge event at intersection %s from <%s,%s> in %s", event.distance, event.intersection_point,
+						 event.vertex_a, event.vertex_b, lav)
 			new_vertex = lav.unify(event.vertex_a, event.vertex_b, event.intersection_point)
 			if lav.head in (event.vertex_a, event.vertex_b):
 				lav.head = new_vertex
@@ -261,40 +709,23 @@ class _SLAV:
 
 	def handle_split_event(self, event):
 		lav = event.vertex.lav
-		log.info("%.2f Split event at intersection %s from vertex %s, for edge %s in %s", event.distance,
-				 event.intersection_point, event.vertex, event.opposite_edge, lav)
+		if _trace:
+			log.info("%.2f Split event at intersection %s from vertex %s, for edge %s in %s", event.distance,
+					 event.intersection_point, event.vertex, event.opposite_edge, lav)
 
 		sinks = [event.vertex.point]
 		vertices = []
-		x = None  # right vertex
-		y = None  # left vertex
-		norm = event.opposite_edge.v.normalized()
-		for v in chain.from_iterable(self._lavs):
-			log.debug("%s in %s", v, v.lav)
-			if norm == v.edge_left.v.normalized() and event.opposite_edge.p == v.edge_left.p:
-				x = v
-				y = x.prev
-			elif norm == v.edge_right.v.normalized() and event.opposite_edge.p == v.edge_right.p:
-				y = v
-				x = y.next
-
-			if x:
-				xleft	= _cross(y.bisector.v.normalized(), (event.intersection_point - y.point).normalized()) >= -EPSILON
-				xright	= _cross(x.bisector.v.normalized(), (event.intersection_point - x.point).normalized()) <= EPSILON
-				log.debug("Vertex %s holds edge as %s edge (%s, %s)", v, ("left" if x == v else "right"), xleft, xright)
-
-				if xleft and xright:
-					break
-				else:
-					x = None
-					y = None
+		x, y = self._find_edge_holder(event.opposite_edge, event.intersection_point)  # right, left vertex
 
 		if x is None:
-			log.info("Failed split event %s (equivalent edge event is expected to follow)", event)
+			if _trace:
+				log.info("Failed split event %s (equivalent edge event is expected to follow)", event)
 			return (None, [])
 
 		v1 = _LAVertex(event.intersection_point, event.vertex.edge_left, event.opposite_edge)
 		v2 = _LAVertex(event.intersection_point, event.opposite_edge, event.vertex.edge_right)
+		self._register(v1)
+		self._register(v2)
 
 		v1.prev = event.vertex.prev
 		v1.next = x
@@ -317,12 +748,14 @@ class _SLAV:
 			new_lavs = [_LAV.from_chain(v1, self), _LAV.from_chain(v2, self)]
 
 		for l in new_lavs:
-			log.debug(l)
+			if _trace:
+				log.debug(l)
 			if len(l) > 2:
 				self._lavs.append(l)
 				vertices.append(l.head)
 			else:
-				log.info("LAV %s has collapsed into the line %s--%s", l, l.head.point, l.head.next.point)
+				if _trace:
+					log.info("LAV %s has collapsed into the line %s--%s", l, l.head.point, l.head.next.point)
 				sinks.append(l.head.next.point)
 				for v in list(l):
 					v.invalidate()
@@ -338,19 +771,23 @@ class _SLAV:
 
 
 class _LAV:
+	__slots__ = ("head", "_slav", "_len")
+
 	def __init__(self, slav):
 		self.head = None
 		self._slav = slav
 		self._len = 0
-		log.debug("Created LAV %s", self)
+		if _trace:
+			log.debug("Created LAV %s", self)
 
 	@classmethod
 	def from_polygon(cls, polygon, slav):
 		lav = cls(slav)
 		for prev, point, next in _window(polygon):
 			lav._len += 1
-			vertex = _LAVertex(point, LineSegment2(prev, point), LineSegment2(point, next))
+			vertex = _LAVertex(point, _Segment(prev, point), _Segment(point, next))
 			vertex.lav = lav
+			slav._register(vertex)
 			if lav.head is None:
 				lav.head = vertex
 				vertex.prev = vertex.next = vertex
@@ -372,16 +809,19 @@ class _LAV:
 
 	def invalidate(self, vertex):
 		assert vertex.lav is self, "Tried to invalidate a vertex that's not mine"
-		log.debug("Invalidating %s", vertex)
+		if _trace:
+			log.debug("Invalidating %s", vertex)
 		vertex._valid = False
+		self._slav._unregister(vertex)
 		if self.head == vertex:
 			self.head = self.head.next
 		vertex.lav = None
 
 	def unify(self, vertex_a, vertex_b, point):
 		replacement = _LAVertex(point, vertex_a.edge_left, vertex_b.edge_right,
-								(vertex_b.bisector.v.normalized(), vertex_a.bisector.v.normalized()))
+								(vertex_b.bisector.direction, vertex_a.bisector.direction))
 		replacement.lav = self
+		self._slav._register(replacement)
 
 		if self.head in [vertex_a, vertex_b]:
 			self.head = replacement
@@ -408,11 +848,16 @@ class _LAV:
 
 	def __iter__(self):
 		cur = self.head
+		steps = 0
+		limit = self._slav._vertex_count
 		while True:
 			yield cur
 			cur = cur.next
 			if cur == self.head:
 				return
+			steps += 1
+			if steps > limit:
+				self._slav._check_chain(steps)
 
 	def _show(self):
 		cur = self.head
@@ -441,6 +886,9 @@ class _EventQueue:
 	def empty(self):
 		return len(self.__data) == 0
 
+	def __len__(self):
+		return len(self.__data)
+
 	def peek(self):
 		return self.__data[0]
 
@@ -470,7 +918,7 @@ def _merge_sources(skeleton):
 		skeleton.pop(i)
 
 			
-def skeletonize(polygon, holes=None):
+def skeletonize(polygon, holes=None, max_events=None, max_seconds=None):
 	"""
 	Compute the straight skeleton of a polygon.
 
@@ -481,7 +929,26 @@ def skeletonize(polygon, holes=None):
 
 	Returns the straight skeleton as a list of "subtrees", which are in the form of (source, height, sinks),
 	where source is the highest points, height is its height, and sinks are the point connected to the source.
+
+	max_events and max_seconds bound the number of events taken from the queue and the running time;
+	when either is exceeded SkeletonBudgetExceeded is raised. It is also raised, whatever the budget,
+	when degenerate input leaves a vertex chain that no longer closes.
 	"""
+	global _trace, _draw
+	_trace = not _production and log.isEnabledFor(logging.INFO)
+	_draw = not _production and _debug.do
+	stats = _stats
+	started = time.perf_counter()
+	deadline = started + max_seconds if max_seconds is not None else None
+	edge_events = split_events = peak_events = discarded_events = failed_splits = 0
+
+	def check_budget(events):
+		if (max_events is not None and events > max_events) or (deadline is not None and time.perf_counter() > deadline):
+			if stats is not None:
+				stats.budget_exceeded += 1
+			raise SkeletonBudgetExceeded("skeletonize gave up after {} events and {:.1f}s on {} vertices".format(
+				events, time.perf_counter() - started, len(slav._original_edges)))
+
 	slav = _SLAV(polygon, holes)
 	output = []
 	prioque = _EventQueue()
@@ -489,29 +956,60 @@ def skeletonize(polygon, holes=None):
 	for lav in slav:
 		for vertex in lav:
 			prioque.put(vertex.next_event())
+			if deadline is not None:
+				check_budget(0)
+	max_queue = len(prioque)
 
+	events_taken = 0
 	while not (prioque.empty() or slav.empty()):
-		log.debug("SLAV is %s", [repr(lav) for lav in slav])
+		events_taken += 1
+		check_budget(events_taken)
+		if _trace and log.isEnabledFor(logging.DEBUG):
+			log.debug("SLAV is %s", [repr(lav) for lav in slav])
 		i = prioque.get()
 		if isinstance(i, _EdgeEvent):
 			if not i.vertex_a.is_valid or not i.vertex_b.is_valid:
-				log.info("%.2f Discarded outdated edge event %s", i.distance, i)
+				if _trace:
+					log.info("%.2f Discarded outdated edge event %s", i.distance, i)
+				discarded_events += 1
 				continue
 
+			if i.vertex_a.prev == i.vertex_b.next:
+				peak_events += 1
+			else:
+				edge_events += 1
 			(arc, events) = slav.handle_edge_event(i)
 		elif isinstance(i, _SplitEvent):
 			if not i.vertex.is_valid:
-				log.info("%.2f Discarded outdated split event %s", i.distance, i)
+				if _trace:
+					log.info("%.2f Discarded outdated split event %s", i.distance, i)
+				discarded_events += 1
 				continue
+			split_events += 1
 			(arc, events) = slav.handle_split_event(i)
+			if arc is None:
+				failed_splits += 1
 
 		prioque.put_all(events)
+		max_queue = max(max_queue, len(prioque))
 
 		if arc is not None:
 			output.append(arc)
-			for sink in arc.sinks:
-				_debug.line((arc.source.x, arc.source.y, sink.x, sink.y), fill="red")
+			if _draw:
+				for sink in arc.sinks:
+					_debug.line((arc.source[0], arc.source[1], sink[0], sink[1]), fill="red")
 
-			_debug.show()
+				_debug.show()
 	_merge_sources(output)
-	return output
+	skeleton = [Subtree(Point2(*arc.source), arc.height, [Point2(*sink) for sink in arc.sinks]) for arc in output]
+
+	if stats is not None:
+		stats.calls += 1
+		stats.edge_events += edge_events
+		stats.split_events += split_events
+		stats.peak_events += peak_events
+		stats.discarded_events += discarded_events
+		stats.failed_splits += failed_splits
+		stats.max_queue = max(stats.max_queue, max_queue)
+		stats.timings.append((len(slav._original_edges), time.perf_counter() - started))
+	return skeleton